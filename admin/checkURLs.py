@@ -0,0 +1,182 @@
+############################################################################
+#                                                                          #
+#                             CHECKURLS.PY:                                #
+#        Bulk check of the URLs in a data file before generating XML       #
+#                                                                          #
+############################################################################
+#                                                                          #
+# Recommended command to run this program (from the main directory):      #
+#                                                                          #
+#     python3 admin/checkURLs.py                                           #
+#                                                                          #
+# Every URL in the SharestreamURLs and DigitalCollectionsURLs columns is   #
+# fetched once, and the page title extracted as in fetchURLtitle.py. The   #
+# requests run concurrently over a pooled HTTP session, with a limit on    #
+# the request rate to each host. Responses are cached in urlcache.db for   #
+# a week (failed checks for a quarter of an hour, so that a passing        #
+# network problem is soon retried), so checking the same URLs again is     #
+# nearly instant. The result for every row is written to                   #
+# output/urlreport.csv.                                                    #
+#                                                                          #
+############################################################################
+
+
+# Import needed modules
+import concurrent.futures, csv, os, sqlite3, sys, threading, time, urllib.parse
+import requests
+from requests.adapters import HTTPAdapter
+from fetchURLtitle import extractTitle
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import xmlgen2
+
+
+# Settings
+urlColumns = ('SharestreamURLs', 'DigitalCollectionsURLs')    # data columns holding URLs
+maxWorkers = 16             # number of requests in flight at once
+hostInterval = 0.25         # minimum number of seconds between requests to the same host
+timeout = 10                # seconds to wait for a server to connect or respond
+titleBytes = 65536          # amount of each page read when looking for its title
+cacheFile = 'urlcache.db'   # on-disk cache of responses
+cacheExpiry = 7 * 86400     # number of seconds a cached response stays valid...
+failureExpiry = 900         # ...or a cached failure (no response, or a status of 400 or more)
+reportFile = 'output/urlreport.csv'
+
+
+# Spaces out the requests made to each host, so that no host receives more than one
+# request every 'interval' seconds however many worker threads are running.
+class HostRateLimiter:
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.nextSlot = {}
+
+    def wait(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.nextSlot.get(host, now))
+            self.nextSlot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Creates an HTTP session whose connection pool is large enough for all the worker threads.
+def createSession(workers=maxWorkers):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Opens the response cache, creating it if needed.
+def openCache(path=cacheFile):
+    cache = sqlite3.connect(path)
+    cache.execute('''CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, checked REAL,
+                     status INTEGER, title TEXT, error TEXT)''')
+    return cache
+
+
+# Returns the cached results for those URLs that were checked within the expiry period, which
+# is much shorter for failures so that timeouts and server errors are checked again soon.
+def loadCached(cache, urls, expiry=cacheExpiry, failureExpiry=failureExpiry):
+    results = {}
+    now = time.time()
+    for url in urls:
+        row = cache.execute('''SELECT status, title, error FROM responses WHERE url = ? AND checked >
+                               CASE WHEN status < 400 THEN ? ELSE ? END''',
+                            (url, now - expiry, now - failureExpiry)).fetchone()
+        if row:
+            results[url] = {'status' : row[0], 'title' : row[1], 'error' : row[2], 'cached' : True}
+    return results
+
+
+# Fetches a single URL, returning its HTTP status and page title, or the error that occurred.
+def checkURL(session, limiter, url, timeout=timeout):
+    result = {'status' : None, 'title' : None, 'error' : None, 'cached' : False}
+    limiter.wait(url)
+    try:
+        with session.get(url, timeout=timeout, stream=True) as response:
+            result['status'] = response.status_code
+            page = response.raw.read(titleBytes, decode_content=True)
+            result['title'] = extractTitle(page.decode(response.encoding or 'utf-8', 'replace'))
+            if response.status_code >= 400:
+                result['error'] = response.reason
+    except requests.RequestException as e:
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    return result
+
+
+# Checks a collection of URLs, answering from the cache where possible and fetching the rest
+# concurrently. Newly fetched responses are saved to the cache. Returns a dict of results by URL.
+def checkURLs(urls, cache, session=None, workers=maxWorkers, interval=hostInterval):
+    urls = set(urls)
+    results = loadCached(cache, urls)
+    pending = [url for url in urls if url not in results]
+    print('{0} distinct URLs: {1} cached, {2} to check.'.format(len(urls), len(results), len(pending)))
+    if session is None:
+        session = createSession(workers)
+    limiter = HostRateLimiter(interval)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(checkURL, session, limiter, url) : url for url in pending}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), 1):
+            url = futures[future]
+            results[url] = future.result()
+            cache.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)',
+                          (url, time.time(), results[url]['status'], results[url]['title'],
+                           results[url]['error']))
+            if done % 100 == 0:
+                print('Checked {0} of {1}...'.format(done, len(pending)))
+    cache.commit()
+    return results
+
+
+# Reads the URLs out of each row of the data file, returning a list of
+# (line number, Identifier, column, URL) entries. Cells may hold several URLs separated by ';'.
+# The file is read as xmlgen2.py reads it, in whatever encoding it was saved.
+def readURLs(dataFileName, columns=urlColumns):
+    entries = []
+    reader = csv.DictReader(xmlgen2.readDataFile(dataFileName))
+    for row in reader:
+        for column in columns:
+            for url in (row.get(column) or '').split(';'):
+                if url.strip() != '':
+                    entries.append((reader.line_num, row.get('Identifier', ''), column, url.strip()))
+    return entries
+
+
+# Writes the per-row report, returning the number of URLs that failed.
+def writeReport(entries, results, path=reportFile):
+    failures = 0
+    with open(path, 'w', newline='') as report:
+        writer = csv.writer(report)
+        writer.writerow(['Line', 'Identifier', 'Column', 'URL', 'Result', 'Status', 'Title', 'Error', 'Cached'])
+        for line, identifier, column, url in entries:
+            r = results[url]
+            if r['status'] is not None and r['status'] < 400:
+                outcome = 'OK'
+            else:
+                outcome = 'FAILED'
+                failures += 1
+            writer.writerow([line, identifier, column, url, outcome, r['status'], r['title'], r['error'],
+                             'Y' if r['cached'] else 'N'])
+    return failures
+
+
+def main():
+    dataFileName = input('\nEnter the name of the data file: ')
+    entries = readURLs(dataFileName)
+    print('Found {0} URLs in columns {1}.'.format(len(entries), ', '.join(urlColumns)))
+    cache = openCache()
+    start = time.time()
+    results = checkURLs([url for line, identifier, column, url in entries], cache)
+    cache.close()
+    failures = writeReport(entries, results)
+    print('\nChecked in {0:.1f} seconds: {1} OK, {2} failed.'.format(time.time() - start,
+                                                                     len(entries) - failures, failures))
+    print('Report written to {0}.'.format(reportFile))
+
+
+if __name__ == '__main__':
+    main()
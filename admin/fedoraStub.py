@@ -0,0 +1,221 @@
+############################################################################
+#                                                                          #
+#                            FEDORASTUB.PY:                                #
+#       A local stand-in for the Fedora server, for testing offline        #
+#                                                                          #
+############################################################################
+#                                                                          #
+# Recommended command to run this program (from the main directory):      #
+#                                                                          #
+#     python3 admin/fedoraStub.py [port]                                   #
+#                                                                          #
+# The stub answers the requests xmlgen2.py makes of Fedora: getNextPID     #
+# returns PIDs in the format of pids.xml, objects can be ingested by       #
+# POSTing their FOXML, and /get/[PID] reports whether an object exists.    #
+# Every response can be delayed, failed or throttled at configurable       #
+# rates (see the settings below), to see how the clients behave on a slow  #
+# or overloaded server. Point xmlgen2.py at it by setting                  #
+# fedoraServers['S'] to http://localhost:8080/fedora. The objects live in  #
+# memory only, and any username and password are accepted.                 #
+#                                                                          #
+############################################################################
+
+
+# Import needed modules
+import http.server, random, re, sys, threading, time, urllib.parse
+
+
+# Settings
+port = 8080
+firstPid = 900000           # number of the first PID handed out
+latency = 0.05              # seconds taken to answer every request...
+latencyJitter = 0.02        # ...plus a random extra of up to this many seconds
+slowRate = 0.01             # fraction of requests that take slowLatency seconds instead
+slowLatency = 1.0
+errorRate = 0.0             # fraction of requests that fail with errorStatus
+errorStatus = 503
+throttleRate = 0            # requests per second served before answering 429 (0 for no limit)
+
+
+# The state of the stub server: the next PID to hand out, the objects ingested (PID -> label),
+# the request counts by outcome and the throttle's token bucket, shared by all request threads.
+class StubState:
+
+    def __init__(self, firstPid=firstPid, latency=latency, latencyJitter=latencyJitter, slowRate=slowRate,
+                 slowLatency=slowLatency, errorRate=errorRate, errorStatus=errorStatus, throttleRate=throttleRate):
+        self.nextPid = firstPid
+        self.latency = latency
+        self.latencyJitter = latencyJitter
+        self.slowRate = slowRate
+        self.slowLatency = slowLatency
+        self.errorRate = errorRate
+        self.errorStatus = errorStatus
+        self.throttleRate = throttleRate
+        self.objects = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.tokens = throttleRate
+        self.refilled = time.monotonic()
+
+    def count(self, outcome):
+        with self.lock:
+            self.counts[outcome] = self.counts.get(outcome, 0) + 1
+
+    # Hands out the next numPids PIDs.
+    def takePids(self, numPids):
+        with self.lock:
+            first = self.nextPid
+            self.nextPid += numPids
+        return ['umd:{0}'.format(n) for n in range(first, first + numPids)]
+
+    # Takes a token from the throttle's bucket, which refills at throttleRate tokens a second
+    # up to one second's worth. Returns False if the bucket is empty.
+    def admit(self):
+        if not self.throttleRate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.throttleRate, self.tokens + (now - self.refilled) * self.throttleRate)
+            self.refilled = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    # Returns the delay to apply to a response.
+    def delay(self):
+        if random.random() < self.slowRate:
+            return self.slowLatency
+        return self.latency + random.uniform(0, self.latencyJitter)
+
+
+# Answers the requests of one connection, with the delay, errors and throttling of the state.
+# The headers and body of a response go out in separate writes, so Nagle's algorithm is turned
+# off; otherwise every response on a kept-alive connection waits for a delayed ACK (~40 ms).
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body='', contentType='text/xml', headers=()):
+        self.state.count(status)
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', contentType + '; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Applies the throttle, delay and error rate, returning False if the request was answered already.
+    def admit(self):
+        if not self.state.admit():
+            self.respond(429, 'Too many requests', 'text/plain', [('Retry-After', '1')])
+            return False
+        time.sleep(self.state.delay())
+        if random.random() < self.state.errorRate:
+            self.respond(self.state.errorStatus, 'Injected error', 'text/plain')
+            return False
+        return True
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if not self.admit():
+            return
+        if url.path == '/fedora/management/getNextPID':
+            numPids = int(query.get('numPids', ['1'])[0])
+            pids = self.state.takePids(numPids)
+            self.respond(200, pidListXML(pids))
+            return
+        m = re.match(r'/fedora/get/([^/]+)$', url.path)
+        if m:
+            pid = urllib.parse.unquote(m.group(1))
+            if pid not in self.state.objects:
+                self.respond(404, 'Object not found in low-level storage: {0}'.format(pid), 'text/plain')
+            else:
+                self.respond(200, objectProfileXML(pid, self.state.objects[pid]))
+            return
+        self.respond(404, 'Not found', 'text/plain')
+
+    # Ingests a FOXML document, as POSTed to /fedora/objects/[PID] or /fedora/objects/new.
+    def do_POST(self):
+        url = urllib.parse.urlsplit(self.path)
+        foxml = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8', 'replace')
+        if not self.admit():
+            return
+        m = re.match(r'/fedora/objects/([^/]+)$', url.path)
+        if not m:
+            self.respond(404, 'Not found', 'text/plain')
+            return
+        pid = urllib.parse.unquote(m.group(1))
+        if pid == 'new':
+            pid = re.search(r'<foxml:digitalObject[^>]*\sPID="([^"]+)"', foxml)
+            if not pid:
+                self.respond(400, 'No PID in FOXML', 'text/plain')
+                return
+            pid = pid.group(1)
+        if pid in self.state.objects:
+            self.respond(500, 'ObjectExistsException: {0}'.format(pid), 'text/plain')
+            return
+        label = re.search(r'NAME="info:fedora/fedora-system:def/model#label" VALUE="([^"]*)"', foxml)
+        self.state.objects[pid] = label.group(1) if label else ''
+        self.respond(201, pid, 'text/plain')
+
+
+# Formats a list of PIDs as getNextPID does (see pids.xml).
+def pidListXML(pids):
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<pidList  xmlns:xsd="http://www.w3.org/2001/XMLSchema" '
+             'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+             'xsi:schemaLocation="http://www.fedora.info/definitions/1/0/management/ '
+             'http://fedora.lib.umd.edu:80/getNextPIDInfo.xsd">']
+    lines.extend('  <pid>{0}</pid>'.format(pid) for pid in pids)
+    lines.append('</pidList>')
+    return '\n'.join(lines) + '\n'
+
+
+# Formats the profile of an ingested object, as /get/[PID]?xml=true does.
+def objectProfileXML(pid, label):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<objectProfile pid="{0}">\n'
+            '  <objLabel>{1}</objLabel>\n</objectProfile>\n'.format(pid, label))
+
+
+# Starts the stub server in a background thread, returning the server (whose base URL is
+# serverURL(server)) and its state.
+def startServer(state=None, port=port):
+    if state is None:
+        state = StubState()
+    handler = type('StubHandler', (StubHandler,), {'state' : state})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, state
+
+
+# Returns the base URL of a running stub, for use in place of one of xmlgen2's fedoraServers.
+def serverURL(server):
+    return 'http://127.0.0.1:{0}/fedora'.format(server.server_address[1])
+
+
+def main():
+    server, state = startServer(port=int(sys.argv[1]) if len(sys.argv) > 1 else port)
+    print('Stub Fedora server running at {0} (press Ctrl-C to stop).'.format(serverURL(server)))
+    print('Latency {0}s (+{1}s jitter, {2:.0%} at {3}s), {4:.0%} errors, throttle {5}.'.format(
+          latency, latencyJitter, slowRate, slowLatency, errorRate,
+          '{0} requests/second'.format(throttleRate) if throttleRate else 'off'))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print('\nServed: ' + ', '.join('{0} x {1}'.format(n, status) for status, n in sorted(state.counts.items())))
+        print('{0} objects ingested, next PID umd:{1}.'.format(len(state.objects), state.nextPid))
+
+
+if __name__ == '__main__':
+    main()
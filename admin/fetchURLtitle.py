@@ -5,15 +5,18 @@ def fetchWebpage(url):
 
 def extractTitle(data):
     import re
-    r = re.compile('<title>(.*?)</title>')
+    r = re.compile('<title>(.*?)</title>', re.IGNORECASE | re.DOTALL)
     m = r.search(data)
     if m:
-        return m.group(1)
+        return m.group(1).strip()
     else:
-        print('Error: Not found')
-
-target = input('Enter the URL from which you would like to extract the title:')
-webpage = fetchWebpage(target)
-result = extractTitle(webpage)
-print(result)
+        return None
 
+if __name__ == '__main__':
+    target = input('Enter the URL from which you would like to extract the title:')
+    webpage = fetchWebpage(target)
+    result = extractTitle(webpage)
+    if result is None:
+        print('Error: Not found')
+    else:
+        print(result)
@@ -0,0 +1,137 @@
+############################################################################
+#                                                                          #
+#                             LOADTEST.PY:                                 #
+#       Throughput and tail latency of xmlgen2's requests to Fedora        #
+#                                                                          #
+############################################################################
+#                                                                          #
+# Recommended command to run this program (from the main directory):      #
+#                                                                          #
+#     python3 admin/loadTest.py [base URL of a stub server]                #
+#                                                                          #
+# Drives the network clients of xmlgen2.py (fetchPids for getNextPID and   #
+# probePid for reconcile) with a range of worker counts, and ingests half  #
+# of the PIDs handed out so that probes find both present and missing      #
+# objects. For each phase and worker count, the throughput and the 50th,   #
+# 95th and 99th percentile latencies are reported, along with the number   #
+# of requests the server saw (retries included) when the stub is run by    #
+# this script. By default a stub server (admin/fedoraStub.py) is started   #
+# in the background with the latency, error and throttle settings of that  #
+# script; edit them there to try other conditions. Use this to tune        #
+# networkWorkers and networkRetries in xmlgen2.py offline.                 #
+#                                                                          #
+############################################################################
+
+
+# Import needed modules
+import concurrent.futures, contextlib, io, math, os, sys, time
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fedoraStub, xmlgen2
+
+
+# Settings
+workerCounts = (1, 4, 16, 32)   # numbers of concurrent workers to try
+pidRequests = 50                # getNextPID requests made with each worker count
+pidsPerRequest = 4              # PIDs asked for in each request
+retries = xmlgen2.networkRetries
+
+
+# Ingests a minimal UMDM object through the REST API, as an ingest tool would.
+def ingestObject(session, baseUrl, pid):
+    foxml = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<foxml:digitalObject PID="{0}" xmlns:foxml="info:fedora/fedora-system:def/foxml#">\n'
+             '  <foxml:objectProperties>\n'
+             '    <foxml:property NAME="info:fedora/fedora-system:def/model#label" VALUE="{1}"/>\n'
+             '  </foxml:objectProperties>\n'
+             '</foxml:digitalObject>\n').format(pid, xmlgen2.expectedLabels['UMDM'])
+    response = session.post(baseUrl + '/objects/new', data=foxml.encode('utf-8'),
+                            headers={'Content-Type' : 'text/xml'}, timeout=xmlgen2.networkTimeout)
+    response.raise_for_status()
+
+
+# Calls 'call' on every item with the given number of worker threads, timing each call.
+# Returns the wall-clock time taken, the latencies of all calls, their results, and the
+# number of calls that raised an exception (whose result is the exception).
+def runPhase(call, items, workers):
+    def timed(item):
+        start = time.perf_counter()
+        try:
+            result = call(item)
+        except Exception as e:
+            result = e
+        return time.perf_counter() - start, result
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        timings = list(executor.map(timed, items))
+    wall = time.perf_counter() - start
+    latencies = sorted(latency for latency, result in timings)
+    results = [result for latency, result in timings]
+    errors = sum(1 for result in results if isinstance(result, Exception))
+    return wall, latencies, results, errors
+
+
+# Returns the p-th percentile of a sorted list of values (nearest rank).
+def percentile(values, p):
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+# Prints one line of the results table. 'served' is None when the server is not run by this script.
+def report(phase, workers, count, wall, latencies, errors, served):
+    print('{0:<8}{1:>8}{2:>9}{3:>8}{4:>9}{5:>10.1f}{6:>9.0f}{7:>9.0f}{8:>9.0f}'.format(
+          phase, workers, count, errors, '-' if served is None else served, count / wall,
+          percentile(latencies, 50) * 1000, percentile(latencies, 95) * 1000, percentile(latencies, 99) * 1000))
+
+
+def main():
+    state = None
+    if len(sys.argv) > 1:
+        baseUrl = sys.argv[1].rstrip('/')
+        if baseUrl in xmlgen2.fedoraServers.values():
+            print('Refusing to load test {0}: run this against a stub server.'.format(baseUrl))
+            return
+    else:
+        server, state = fedoraStub.startServer(port=0)
+        baseUrl = fedoraStub.serverURL(server)
+        print('Started a stub server at {0}: latency {1}s (+{2}s jitter, {3:.0%} at {4}s), {5:.0%} errors, '
+              'throttle {6}.'.format(baseUrl, state.latency, state.latencyJitter, state.slowRate, state.slowLatency,
+                                     state.errorRate, '{0} requests/second'.format(state.throttleRate)
+                                                      if state.throttleRate else 'off'))
+    print('Retries: {0}, timeout: {1}s.\n'.format(retries, xmlgen2.networkTimeout))
+    print('{0:<8}{1:>8}{2:>9}{3:>8}{4:>9}{5:>10}{6:>9}{7:>9}{8:>9}'.format(
+          'Phase', 'Workers', 'Requests', 'Errors', 'Served', 'Req/s', 'p50 ms', 'p95 ms', 'p99 ms'))
+
+    for workers in workerCounts:
+        session = xmlgen2.createSession(None, workers, retries)
+        def servedSince(before):        # requests answered by the stub since 'before'
+            return sum(state.counts.values()) - before if state else None
+
+        # Reserve PIDs, as requestPids and the watcher do
+        before = servedSince(0)
+        with contextlib.redirect_stdout(io.StringIO()):     # parsePids prints every PID
+            wall, latencies, results, errors = runPhase(
+                lambda n: xmlgen2.parsePids(xmlgen2.fetchPids(session, baseUrl, n)),
+                [pidsPerRequest] * pidRequests, workers)
+        report('pids', workers, pidRequests, wall, latencies, errors, servedSince(before))
+        pids = [pid for result in results if not isinstance(result, Exception) for pid in result]
+
+        # Ingest every other PID, so that probes find both present and missing objects
+        before = servedSince(0)
+        wall, latencies, results, errors = runPhase(lambda pid: ingestObject(session, baseUrl, pid),
+                                                    pids[::2], workers)
+        report('ingest', workers, len(pids[::2]), wall, latencies, errors, servedSince(before))
+
+        # Probe all of them, as reconcile does
+        before = servedSince(0)
+        wall, latencies, results, errors = runPhase(lambda pid: xmlgen2.probePid(session, baseUrl, pid, 'UMDM'),
+                                                    pids, workers)
+        errors += sum(1 for result in results if not isinstance(result, Exception) and result[0] == 'error')
+        report('probe', workers, len(pids), wall, latencies, errors, servedSince(before))
+        session.close()
+
+    if state:
+        print('\nServer responses: ' + ', '.join('{0} x {1}'.format(n, status)
+                                                 for status, n in sorted(state.counts.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,12 +17,105 @@
 # The program assumes that CSV and XML template files are located in the   #
 # same directory as the script itself. It also assumes there will be a     #
 # subdirectory called output containing another directory called foxml.    #
+#                                                                          #
+# Every file written is also indexed in the SQLite manifest (manifest.db), #
+# which keeps a record of all past runs. To find which batch produced a    #
+# PID, Identifier or FileName, run:                                        #
+#                                                                          #
+#     python3 xmlgen2.py lookup umd:489985 ID0001 ...                      #
+#                                                                          #
+# After a partial ingest, check which PIDs of a run (from the pids.txt and #
+# UMDMpids.txt summary files) already exist on the server with:            #
+#                                                                          #
+#     python3 xmlgen2.py reconcile [directory of summary files]            #
+#                                                                          #
+# To regenerate the FOXML of selected records with their original PIDs,    #
+# after correcting the data file, run:                                     #
+#                                                                          #
+#     python3 xmlgen2.py regenerate umd:489985 ID0001 ...                  #
+#                                                                          #
+# To generate FOXML unattended for every CSV dropped into hotfolder/inbox, #
+# answer the usual questions once and leave running:                       #
+#                                                                          #
+#     python3 xmlgen2.py watch [hot folder]                                #
 #                                                                          #       
 ############################################################################
 
 
 # Import needed modules
-import csv, datetime, re, requests
+import array, codecs, concurrent.futures, contextlib, csv, datetime, functools, hashlib, io, json, multiprocessing, os, re, requests, sqlite3, sys, tempfile, time, unicodedata, urllib3
+
+
+# Location of the manifest database recording the output of every run
+manifestFile = 'manifest.db'
+
+# Base URLs of the stage and production Fedora servers
+fedoraServers = {
+                'S' :       'http://fedorastage.lib.umd.edu/fedora',
+                'P' :       'http://fedora.lib.umd.edu/fedora'
+}
+
+# Concurrent requests, retries of failed requests and timeout (in seconds) for the servers
+networkWorkers = 16
+networkRetries = 3
+networkTimeout = 30
+
+# Object labels set by the UMDM and UMAM templates, used to check objects found on the server
+expectedLabels = {
+                'UMDM' :    'UMDM Object',
+                'UMAM' :    'UMAM Object'
+}
+
+# Data columns which must be unique for each XMLType, both within a batch and across all
+# batches recorded in the manifest (UMAMs in a group legitimately share their Identifier)
+uniqueFields = {
+                'UMDM' :    ('Identifier',),
+                'UMAM' :    ('FileName',)
+}
+
+# Watch mode: seconds between scans of the inbox, seconds a new file's size and modification
+# time must stay unchanged before it is picked up, seconds a file ending in the middle of a
+# quoted value may stay unchanged before it is failed, and number of PIDs to keep reserved
+watchInterval = 0.2
+watchSettle = 0.5
+watchIncomplete = 60
+watchPidPool = 500
+
+# UMAM templates for each kind of media, with the content model and MIME type of their objects
+# (audio objects share the video content model, for streaming). The template for each UMAM
+# row is picked by the words in its MediaType and Format columns (see chooseUmamTemplate),
+# and rows that match none of the kinds get the template of defaultMediaKind.
+umamTemplates = {
+                'video' :   {'file' : 'umam_video.xml', 'contentModel' : 'UMD_VIDEO', 'mimeType' : 'video/mp4',
+                             'match' : ('video', 'film', 'moving image', 'vhs', 'dvd', 'betacam', 'u-matic')},
+                'audio' :   {'file' : 'umam_audio.xml', 'contentModel' : 'UMD_VIDEO', 'mimeType' : 'audio/mpeg',
+                             'match' : ('audio', 'sound', 'cassette', 'phonograph')}
+}
+defaultMediaKind = 'audio'
+
+# Encodings assumed for data files which are not UTF-8: Windows-1252, or Mac Roman for files
+# with old Mac (CR only) line endings, as saved by Excel's "CSV (Macintosh)" format
+legacyEncoding = 'cp1252'
+legacyMacEncoding = 'mac_roman'
+
+# Hash algorithm for the digests of the files written, recorded in the manifest and exported
+# to output/checksums.txt (any hashlib name; Fedora accepts md5, sha1, sha256, sha384, sha512).
+# With embedDigests on, the contentDigest of each inline XML datastream is also filled in.
+# It is off by default because Fedora checks these digests on ingest, and it may re-serialize
+# inline XML so that the stored bytes differ from those written.
+digestAlgorithm = 'sha256'
+embedDigests = False
+fedoraDigestTypes = {'md5' : 'MD5', 'sha1' : 'SHA-1', 'sha256' : 'SHA-256', 'sha384' : 'SHA-384', 'sha512' : 'SHA-512'}
+
+# Number of worker processes generating single-row ('S') data, by default one per core
+singleRowWorkers = os.cpu_count() or 1
+
+# Layout of output/foxml: 'flat' puts every file in the one directory, 'sharded' spreads them
+# over subdirectories by the numeric part of the PID, shardSize consecutive PIDs to each
+# (e.g. output/foxml/489/umd_489985.xml), which keeps directories small for very large batches.
+# Either way, output/foxml_index.txt maps each PID of the batch to its file.
+foxmlLayout = 'flat'
+shardSize = 1000
 
 
 # Initiates interaction with the program and records the time and user.
@@ -34,31 +127,494 @@ def greeting():
     print("\nThis program is designed to take data from a CSV file,")
     print("and use that data to generate FOXML files for the")
     print("University of Maryland's digital collections repository.")
+    return name
+
+
+# A single row of CSV data. The values are kept in a tuple and looked up by column name
+# through a header-index table ('columns') shared by every row of the same data file, so
+# a row costs a handful of slots rather than a dict with an entry for every column.
+# Values can be read as row['Mono/Stereo'] or, for simple column names, as row.FileName.
+# The XMLType is stripped of spaces as the row is read, so that the planner, the generator,
+# the duplicate checks and the row index all see the same type (see normalizeXMLType).
+class DataRow:
+    __slots__ = ('values', 'row', 'line', 'offset', 'seq', 'pid', 'umdmPid', 'umamPid')
+    columns = {}
+    typeColumn = None
+
+    def __init__(self, values, row):
+        values = tuple(map(internValue, values))
+        t = self.typeColumn
+        if t is not None and t < len(values) and values[t] != normalizeXMLType(values[t]):
+            values = values[:t] + (internValue(normalizeXMLType(values[t])),) + values[t + 1:]
+        self.values = values
+        self.row = row          # number of the data row, not counting the header
+        self.line = None        # physical line of the data file the row starts on (see readRows)
+        self.offset = None      # byte offset of that line in the data file
+        self.seq = None         # position of the row's (first) PID in the PID list
+        self.pid = None         # PID assigned to the row in multi-row data
+        self.umdmPid = None     # PIDs assigned to the row in single-row data
+        self.umamPid = None
+
+    def __getitem__(self, name):
+        index = self.columns[name]
+        if index < len(self.values):
+            return self.values[index]
+        return ''               # short rows are padded with empty values
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, name, default=''):
+        if name in self.columns:
+            return self[name]
+        return default
+
+
+# Per-batch tables of the distinct cell values read, so that a value repeated on many rows
+# (rights statements, collection names, places...) is held as one shared string and escaped
+# for XML only once. resetValueTables empties them at the start of each batch.
+internedValues = {}
+escapedValues = {}
+
+# Escapes for the five characters with a special meaning in XML
+xmlEscapes = str.maketrans({'&' : '&amp;', '<' : '&lt;', '>' : '&gt;', '"' : '&quot;', "'" : '&apos;'})
+
+def resetValueTables():
+    internedValues.clear()
+    escapedValues.clear()
+
+
+# Returns the shared copy of a cell value.
+def internValue(value):
+    return internedValues.setdefault(value, value)
+
+
+# Returns a value escaped for use in XML text or attributes, looking it up in (or adding it
+# to) the batch's table of escaped values. Values without special characters are shared as is.
+def escapeValue(value):
+    escaped = escapedValues.get(value)
+    if escaped is None:
+        escaped = value.translate(xmlEscapes)
+        if escaped == value:
+            escaped = value
+        escapedValues[value] = escaped
+    return escaped
+
+
+# Creates the row class for a data file from its header, with the column schema attached.
+def makeRowType(header):
+    columns = {name : index for index, name in enumerate(header)}
+    return type('DataRow', (DataRow,), {'__slots__' : (), 'columns' : columns,
+                                        'typeColumn' : columns.get('XMLType')})
+
+
+# Returns the XMLType value of a row as it is used throughout: without surrounding spaces
+# (e.g. "UMDM " as saved by some spreadsheets).
+def normalizeXMLType(value):
+    return value.strip()
+
+
+# Reads the lines of the data file, yielding a DataRow for each non-empty row after the header,
+# with the line it starts on (rows can span several lines, and blank lines are skipped) and,
+# for a file read by readDataFile, the byte offset of that line.
+def readRows(dataFile):
+    reader = csv.reader(dataFile)
+    rowType = makeRowType(next(reader))
+    offsets = getattr(dataFile, 'offsets', None)
+    rowNumber = 0
+    lastLine = reader.line_num
+    for values in reader:
+        if values:
+            x = rowType(values, rowNumber)
+            x.line = lastLine + 1
+            if offsets is not None:
+                x.offset = offsets[lastLine]
+            yield x
+            rowNumber += 1
+        lastLine = reader.line_num
+
+
+# Works out the encoding of a data file once, from its leading bytes: UTF-8 if it starts with
+# a byte order mark or decodes as UTF-8, otherwise the legacy encoding of the platform that
+# most likely saved it. UTF-16 files (Excel's "Unicode Text") are rejected.
+def sniffEncoding(fileName, sampleSize=1 << 16):
+    with open(fileName, 'rb') as f:
+        sample = f.read(sampleSize)
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        raise ValueError('{0} is saved as UTF-16 text; save it as CSV (UTF-8) instead.'.format(fileName))
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(sample, final=len(sample) < sampleSize)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        if b'\r' in sample and b'\n' not in sample:
+            return legacyMacEncoding
+        return legacyEncoding
+
 
+# Brings a decoded line into Unicode normalization form C, so that accented characters typed
+# or exported in different ways compare (and are written) the same. ASCII lines are returned
+# as they are; otherwise each run of text between delimiters that contains non-ASCII
+# characters is normalized, through a cache, since the same values recur on many rows.
+def normalizeLine(line):
+    if line.isascii():
+        return line
+    return nonAsciiText.sub(lambda m: normalizeText(m.group()), line)
 
-# Analyzes the type of datafile and calculates the number of PIDs needed.
-def analyzeDataFile(dataFile):
-    dataFileSize = len(dataFile)
-    print('\nDoes your datafile contain single or multiple rows for each object?')
-    dataFileArrangement = input('Please enter S or M: ')
-    while dataFileArrangement not in ('S','M'):
-        dataFileArrangement = input('Please enter either S for sigle-rowed data, or M for multi-rowed data: ')
-    print('\nThe datafile you specified has {0} rows.'.format(dataFileSize))
-    if dataFileArrangement == 'S':
-        print('Since you have single-rowed objects, you need two PIDs for each row.')
-        dataLength = (dataFileSize - 1) * 2
-    elif dataFileArrangement == 'M':
-        print('Since you have multi-rowed objects, you need one PID for each row.')
-        dataLength = dataFileSize - 1
-    print('Assuming there is a header row in your datafile, you need {0} PIDs.'.format(dataLength))
-    print('Load {0} PIDs from a file or request them from the server?'.format(dataLength))
-    return dataLength, dataFileArrangement
+nonAsciiText = re.compile(r'[^,"\n]*[^\x00-\x7f][^,"\n]*')
+
+@functools.lru_cache(maxsize=65536)
+def normalizeText(text):
+    return unicodedata.normalize('NFC', text)
+
+
+# Decodes one physical line of a data file. A line that is not valid in the file's encoding
+# raises UnicodeDecodeError, unless a 'problems' list is given: the problem is then added to
+# it as (offset, description) and the bad bytes are replaced with U+FFFD.
+def decodeLine(raw, encoding, offset, problems=None):
+    try:
+        line = raw.decode(encoding)
+    except UnicodeDecodeError as e:
+        if problems is None:
+            raise
+        problems.append((offset, 'byte 0x{0:02X} at position {1} is not valid {2}'.format(
+                                 raw[e.start], e.start + 1, encoding)))
+        line = raw.decode(encoding, 'replace')
+    return normalizeLine(line)
+
+
+# Yields (offset, line) for each physical line of a data file opened in binary mode, starting
+# at its current position. Lines may end in \r\n, \r or \n, and are decoded (see decodeLine)
+# and returned with a plain \n ending, as the csv module expects. The file is read in large chunks.
+def iterPhysicalLines(f, encoding, chunkSize=1 << 20, problems=None):
+    offset = f.tell()
+    buffer = b''
+    while True:
+        chunk = f.read(chunkSize)
+        buffer += chunk
+        start = 0
+        for m in re.finditer(b'\r\n|\r|\n', buffer):
+            if chunk and m.end() == len(buffer) and m.group() == b'\r':
+                break           # the \n of a \r\n may be in the next chunk
+            yield offset + start, decodeLine(buffer[start:m.start()], encoding, offset + start, problems) + '\n'
+            start = m.end()
+        offset += start
+        buffer = buffer[start:]
+        if not chunk:
+            break
+    if buffer:
+        yield offset, decodeLine(buffer, encoding, offset, problems)
+
+
+# The row offset index of a data file, kept in an SQLite file next to it ([name].idx). The
+# index maps every data row to the byte offset where it starts, with its XMLType, Identifier,
+# FileName and the number of the object group it belongs to, so that selected rows can be read
+# back without parsing the whole file. Groups follow the same rule as generateBatch for the
+# arrangement: in multi-row data each UMDM row starts a group, and rows which were not
+# generated (other XMLTypes, UMAMs before the first UMDM) belong to no group. The index is
+# written as a batch is generated (see startRowIndex), and checked when it is opened again.
+def connectRowIndex(dataFileName):
+    index = sqlite3.connect(dataFileName + '.idx')
+    index.executescript('''
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS rows (row INTEGER PRIMARY KEY, offset INTEGER, grp INTEGER,
+                                         xmlType TEXT, identifier TEXT, fileName TEXT);
+        CREATE INDEX IF NOT EXISTS rowsByGroup ON rows (grp);
+        CREATE INDEX IF NOT EXISTS rowsByIdentifier ON rows (identifier);
+    ''')
+    return index
+
+
+# Returns the group of a row, given the group of the row before it (-1 before the first group).
+def rowGroup(arrangement, xmlType, group):
+    if arrangement == 'S' or xmlType == 'UMDM':
+        return group + 1
+    if xmlType == 'UMAM' and group >= 0:        # UMAMs belong to the preceding UMDM's group
+        return group
+    return None
+
+
+# Starts a new index for the data file of a batch, with the header and arrangement of the data.
+# The rows are added by generateBatch as it goes (see indexRow), and finishRowIndex records the
+# size and modification time of the file they were read from.
+def startRowIndex(dataFileName, dataFile, arrangement):
+    index = connectRowIndex(dataFileName)
+    index.execute('DELETE FROM meta')
+    index.execute('DELETE FROM rows')
+    index.executemany('INSERT INTO meta VALUES (?, ?)', [('arrangement', arrangement),
+                                                         ('header', json.dumps(next(csv.reader(dataFile))))])
+    return index
+
+
+def indexRow(index, x, group):
+    index.execute('INSERT INTO rows VALUES (?, ?, ?, ?, ?, ?)',
+                  (x.row, x.offset, group, x.get('XMLType'), x.get('Identifier'), x.get('FileName')))
+
+
+def finishRowIndex(index, path):
+    stat = os.stat(path)
+    index.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('size', str(stat.st_size)),
+                                                                    ('mtime', str(stat.st_mtime_ns))])
+    index.commit()
+    index.close()
+
+
+# Opens the row index of a data file. If the file has changed since the index was written (as
+# it will have when it was corrected before regenerating), the index is checked rather than
+# rebuilt: the rows are read back at their recorded offsets, in a binary search for the first
+# row which is no longer there, and the file is only scanned again from that row on. An edit
+# which leaves every row where it was is caught by regenerate's checks against the manifest.
+def openRowIndex(dataFileName, encoding, arrangement='M'):
+    stat = os.stat(dataFileName)
+    index = connectRowIndex(dataFileName)
+    meta = dict(index.execute('SELECT key, value FROM meta'))
+    if (meta.get('size') == str(stat.st_size) and meta.get('mtime') == str(stat.st_mtime_ns) and
+            meta.get('arrangement') == arrangement):
+        return index
+
+    with open(dataFileName, 'rb') as f:
+        header = next(csv.reader(line for offset, line in iterPhysicalLines(f, encoding, 1 << 16, [])), [])
+        rowCount = index.execute('SELECT COUNT(*) FROM rows').fetchone()[0]
+        if meta.get('arrangement') != arrangement or meta.get('header') != json.dumps(header) or rowCount == 0:
+            firstStale = 0
+        else:
+            firstStale = findStaleRow(index, f, encoding, makeRowType(header), rowCount)
+        if firstStale == 0:
+            print('\nIndexing the rows of {0}...'.format(dataFileName))
+            f.seek(0)
+            scanRows(index, f, encoding, makeRowType(header), arrangement, 0, -1, skipHeader=True)
+        else:
+            # Scan again from the last row still in place, to find where the next one now starts
+            start = firstStale - 1
+            offset = index.execute('SELECT offset FROM rows WHERE row = ?', (start,)).fetchone()[0]
+            group = index.execute('SELECT MAX(grp) FROM rows WHERE row < ?', (start,)).fetchone()[0]
+            print('\nIndexing the rows of {0} from data row {1}...'.format(dataFileName, start + 1))
+            f.seek(offset)
+            scanRows(index, f, encoding, makeRowType(header), arrangement, start, -1 if group is None else group)
+    index.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', [('size', str(stat.st_size)),
+                                                                    ('mtime', str(stat.st_mtime_ns)),
+                                                                    ('arrangement', arrangement),
+                                                                    ('header', json.dumps(header))])
+    index.commit()
+    return index
+
+
+# Reads the row which starts at an offset of the data file, returning None if there is none.
+def readRowAt(f, encoding, rowType, offset, rowNumber):
+    f.seek(offset)
+    for values in csv.reader(line for start, line in iterPhysicalLines(f, encoding, 1 << 16, [])):
+        if values:
+            return rowType(values, rowNumber)
+        break
+    return None
+
+
+# Returns the number of the first indexed row which is no longer found at its offset with the
+# same XMLType, Identifier and FileName, or the number of rows if all of them still are.
+def findStaleRow(index, f, encoding, rowType, rowCount):
+    def inPlace(rowNumber):
+        offset, xmlType, identifier, fileName = index.execute(
+            'SELECT offset, xmlType, identifier, fileName FROM rows WHERE row = ?', (rowNumber,)).fetchone()
+        x = readRowAt(f, encoding, rowType, offset, rowNumber)
+        return x is not None and (x.get('XMLType'), x.get('Identifier'), x.get('FileName')) == (
+                                  xmlType, identifier, fileName)
+    low, high = 0, rowCount
+    while low < high:
+        middle = (low + high) // 2
+        if inPlace(middle):
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+# Indexes the rows of a data file from its current position (which is the start of the file
+# if skipHeader is set), numbering them from rowNumber on and grouping them after the given
+# group. Any rows indexed from rowNumber on are replaced.
+def scanRows(index, f, encoding, rowType, arrangement, rowNumber, group, skipHeader=False):
+    index.execute('DELETE FROM rows WHERE row >= ?', (rowNumber,))
+    starts = []         # offsets of the lines the csv reader has taken since the last row
+    def lines():
+        # Bad bytes are replaced, as they were when the batch was generated
+        for offset, line in iterPhysicalLines(f, encoding, problems=[]):
+            starts.append(offset)
+            yield line
+    reader = csv.reader(lines())
+    if skipHeader:
+        next(reader, None)
+        del starts[:]
+    for values in reader:
+        if values:
+            x = rowType(values, rowNumber)
+            x.offset = starts[0]
+            xGroup = rowGroup(arrangement, x.get('XMLType'), group)
+            if xGroup is not None:
+                group = xGroup
+            indexRow(index, x, xGroup)
+            rowNumber += 1
+        del starts[:]
+    print('Indexed {0} rows in {1} groups.'.format(rowNumber, group + 1))
+
+
+# Reads the rows of one object group back from the data file, seeking straight to the offset
+# of its first row, and returns them as DataRow records with their original row numbers.
+# Rows in between which belong to no group are passed over.
+def readGroup(dataFileName, encoding, index, group):
+    rowType = makeRowType(json.loads(index.execute("SELECT value FROM meta WHERE key = 'header'").fetchone()[0]))
+    rowNumbers = [r for (r,) in index.execute('SELECT row FROM rows WHERE grp = ? ORDER BY row', (group,))]
+    offset = index.execute('SELECT offset FROM rows WHERE row = ?', (rowNumbers[0],)).fetchone()[0]
+    wanted = set(rowNumbers)
+    rows = []
+    with open(dataFileName, 'rb') as f:
+        f.seek(offset)
+        reader = csv.reader(line for offset, line in iterPhysicalLines(f, encoding, 1 << 16, []))
+        rowNumber = rowNumbers[0]
+        for values in reader:
+            if values:
+                if rowNumber in wanted:
+                    rows.append(rowType(values, rowNumber))
+                    if len(rows) == len(rowNumbers):
+                        break
+                rowNumber += 1
+    return rows
+
+
+# Scans the data file once to plan the batch: detects from the XMLType column whether objects
+# are arranged in single or multiple rows, counts the UMDM groups and UMAM parts, and calculates
+# the exact number of PIDs needed. Blank lines and quoted values spanning several lines are
+# handled by the csv module, so the counts match what the generator will actually produce.
+# When not interactive (in watch mode), problems raise a ValueError instead of prompting.
+def analyzeDataFile(dataFile, interactive=True):
+    plan = {'rows' : 0, 'groups' : 0, 'parts' : 0, 'ignored' : [], 'orphans' : [], 'emptyGroups' : 0}
+    reader = csv.reader(dataFile)
+    header = next(reader)
+    if 'XMLType' in header:
+        typeColumn = header.index('XMLType')
+    else:
+        typeColumn = None
+    otherTypes = set()
+    partsInGroup = None     # number of UMAMs seen in the current group, None before the first UMDM
+    for values in reader:
+        if not values:
+            continue
+        plan['rows'] += 1
+        if typeColumn is not None and typeColumn < len(values):
+            xmlType = normalizeXMLType(values[typeColumn])
+        else:
+            xmlType = ''
+        if xmlType == 'UMDM':
+            if partsInGroup == 0:
+                plan['emptyGroups'] += 1
+            plan['groups'] += 1
+            partsInGroup = 0
+        elif xmlType == 'UMAM':
+            plan['parts'] += 1
+            if partsInGroup is None:
+                plan['orphans'].append(reader.line_num)
+            else:
+                partsInGroup += 1
+        else:
+            plan['ignored'].append(reader.line_num)
+            if xmlType != '':
+                otherTypes.add(xmlType)
+    if partsInGroup == 0:
+        plan['emptyGroups'] += 1
+
+    # Work out the arrangement, only asking the user if the XMLType column is inconclusive
+    if plan['groups'] or plan['parts']:
+        plan['arrangement'] = 'M'
+    elif not otherTypes:
+        plan['arrangement'] = 'S'
+    elif not interactive:
+        raise ValueError('Unrecognized XMLType values: {0}'.format(', '.join(sorted(otherTypes))))
+    else:
+        print('\nUnrecognized XMLType values: {0}'.format(', '.join(sorted(otherTypes))))
+        print('Does your datafile contain single or multiple rows for each object?')
+        plan['arrangement'] = input('Please enter S or M: ')
+        while plan['arrangement'] not in ('S','M'):
+            plan['arrangement'] = input('Please enter either S for sigle-rowed data, or M for multi-rowed data: ')
+
+    print('\nThe datafile you specified has {0} rows of data.'.format(plan['rows']))
+    if plan['arrangement'] == 'S':
+        print('Detected single-rowed objects, so you need two PIDs for each row.')
+        plan['groups'] = plan['parts'] = plan['rows']
+        plan['ignored'] = []
+    else:
+        print('Detected multi-rowed objects: {0} UMDM objects with {1} UMAM parts.'.format(plan['groups'],
+                                                                                          plan['parts']))
+        if plan['ignored']:
+            print('WARNING: rows without a UMDM or UMAM XMLType will be skipped (lines {0}).'.format(
+                  ', '.join(str(i) for i in plan['ignored'])))
+        if plan['emptyGroups']:
+            print('WARNING: {0} UMDM object(s) have no UMAM parts.'.format(plan['emptyGroups']))
+        if plan['orphans'] and not interactive:
+            raise ValueError('UMAM rows appear before the first UMDM row (lines {0})'.format(
+                             ', '.join(str(i) for i in plan['orphans'])))
+        if plan['orphans']:
+            print('ERROR: UMAM rows appear before the first UMDM row (lines {0}).'.format(
+                  ', '.join(str(i) for i in plan['orphans'])))
+            print('Please correct the datafile and try again.')
+            print('Exiting program.')
+            quit()
+    plan['pidsNeeded'] = plan['groups'] + plan['parts']
+    print('You need {0} PIDs.'.format(plan['pidsNeeded']))
+    return plan
+
+
+# Estimates the size of the output and the time it will take to generate, using a benchmark
+# of the actual templates: a sample of rows from the start of the data file is rendered and
+# written to a scratch file, and the per-file cost is scaled up to the batch in the plan.
+def estimateOutput(plan, dataFile, umam, umdm, rights, sampleSize=20):
+    umamSample = []
+    umdmSample = []
+    for x in readRows(dataFile):
+        if plan['arrangement'] == 'S' or x['XMLType'] == 'UMAM':
+            umamSample.append(x)
+        if plan['arrangement'] == 'S' or x['XMLType'] == 'UMDM':
+            umdmSample.append(x)
+        if x.row + 1 >= sampleSize:
+            break
+    if not umamSample or not umdmSample:
+        return
+    with contextlib.redirect_stdout(io.StringIO()), tempfile.TemporaryFile('w', encoding='utf-8') as scratch:
+        start = time.perf_counter()
+        umamBytes = 0
+        for x in umamSample:
+            myFile = createUMAM(x, chooseUmamTemplate(umam, x), 'umd:0', rights)
+            scratch.write(myFile)
+            umamBytes += len(myFile.encode('utf-8'))
+        umamSeconds = (time.perf_counter() - start) / len(umamSample)
+        mets = createMets()
+        metsPart = updateMets(1, mets, umamSample[0]['FileName'], 'umd:0')
+        start = time.perf_counter()
+        umdmBytes = 0
+        for x in umdmSample:
+            myFile = createUMDM(x, umdm, 0, metsPart, 'umd:0', rights)
+            scratch.write(myFile)
+            umdmBytes += len(myFile.encode('utf-8'))
+        umdmSeconds = (time.perf_counter() - start) / len(umdmSample)
+
+    # Each UMDM grows by one METS part for every UMAM in its group beyond the first
+    metsPartBytes = len(metsPart) - len(mets)
+    totalBytes = (plan['parts'] * umamBytes / len(umamSample) +
+                  plan['groups'] * umdmBytes / len(umdmSample) +
+                  max(plan['parts'] - plan['groups'], 0) * metsPartBytes)
+    totalSeconds = plan['parts'] * umamSeconds + plan['groups'] * umdmSeconds
+    print('\nEstimated output: {0} FOXML files, about {1:,.0f} KB.'.format(plan['pidsNeeded'],
+                                                                         totalBytes / 1024))
+    print('Estimated generation time: about {0:.1f} seconds (based on {1} sample rows).'.format(
+          totalSeconds, len(set(x.row for x in umamSample + umdmSample))))
 
 
 # Reads the length of the CSV datafile and guides user in requesting
 # necessary number of PIDs from either the stage (for testing) or production server
 def getPids(dataLength):
     pidList = []
+    print('\nLoad {0} PIDs from a file or request them from the server?'.format(dataLength))
     pidSource = input('Enter F (file) or S (server): ')
     while (pidSource not in ('F','S')):
         print("ERROR: you must enter either 'F' to load PIDs from a file, " +
@@ -72,20 +628,49 @@ def getPids(dataLength):
     return pidFile
 
 
-# Handles the request for PIDs from the server, 
-# requesting a specified number of PIDs and saving the resulting XML file.
-def requestPids(numPids):                   
-    serverChoice = input('Enter S to get PIDs on fedoraStage, P to get PIDs on Production: ')
+# Prompts the user to choose the stage or production server, returning its base URL.
+def chooseServer(action):
+    serverChoice = input('Enter S to {0} on fedoraStage, P to {0} on Production: '.format(action))
     while (serverChoice not in ('S', 'P')): # Choose the production or stage server
         serverChoice = input('Error: You must enter S or P: ')
-    if serverChoice == 'S':
-        url = 'http://fedorastage.lib.umd.edu/fedora/management/getNextPID?numPids='
-    elif serverChoice == 'P':
-        url = 'http://fedora.lib.umd.edu/fedora/management/getNextPID?numPids='
-    url += '{0}&namespace=umd&xml=true'.format(numPids)
-    username = input('\nEnter the server username: ')          # prompts user for auth info
+    return fedoraServers[serverChoice]
+
+
+# Prompts the user for the server username and password.
+def getCredentials():
+    username = input('\nEnter the server username: ')
     password = input('Enter the server password: ')
-    f = requests.get(url, auth=(username, password)).text      # submits request to fedora server
+    return (username, password)
+
+
+# Creates an HTTP session for talking to the Fedora server, with a connection pool large
+# enough for the number of concurrent requests and automatic retries of failed requests.
+def createSession(auth=None, workers=networkWorkers, retries=networkRetries):
+    session = requests.Session()
+    session.auth = auth
+    retry = urllib3.util.Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 502, 503, 504),
+                               allowed_methods=None)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers,
+                                            max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+# Asks the server at baseUrl for the next numPids PIDs, returning the XML PID list.
+def fetchPids(session, baseUrl, numPids):
+    url = baseUrl + '/management/getNextPID?numPids={0}&namespace=umd&xml=true'.format(numPids)
+    response = session.get(url, timeout=networkTimeout)
+    response.raise_for_status()
+    return response.text
+
+
+# Handles the request for PIDs from the server, 
+# requesting a specified number of PIDs and saving the resulting XML file.
+def requestPids(numPids):                   
+    baseUrl = chooseServer('get PIDs')
+    session = createSession(getCredentials())                   # prompts user for auth info
+    f = fetchPids(session, baseUrl, numPids)                    # submits request to fedora server
     print("\nRetrieving PIDs from the server...")
     print('\nServer answered with the following XML file:\n')  # print server's response
     print(f)
@@ -142,11 +727,13 @@ def getRightsScheme():
 
 # Generates the mediaType XML tag, wrapping it around the form XML tag      
 def generateMediaTypeTag(mediaType, formType, form):
-    return '<mediaType type="{0}"><form type="{1}">{2}</form></mediaType>'.format(mediaType, formType, form)
+    return '<mediaType type="{0}"><form type="{1}">{2}</form></mediaType>'.format(escapeValue(mediaType),
+                                                                               escapeValue(formType),
+                                                                               escapeValue(form))
 
 
 # Generates the specific XML tags based on dating information stored in the myDate dictionary
-# previously returned by the parseDate function.
+# previously returned by the parseDate function. Data values are escaped as they are inserted.
 def generateDateTag(inputDate, inputAttribute, centuryData):
     dateTagList = generateCenturyTags(centuryData)  # start result list with century tag(s)
     centuryList = []
@@ -160,15 +747,16 @@ def generateDateTag(inputDate, inputAttribute, centuryData):
             beginDate = elements[0] # i.e. we assume YYYY-MM-DD-YYYY-MM-DD format for exact date ranges
             endDate = elements[4]
         myTag = '<date certainty="{0}" era="ad" from="{1}" to="{2}">{3}</date>'.format(myDate['Certainty'],
-                                                                                       beginDate, endDate,
-                                                                                       myDate['Value'])
+                                                                                       escapeValue(beginDate),
+                                                                                       escapeValue(endDate),
+                                                                                       escapeValue(myDate['Value']))
         dateTagList.append(myTag)
     elif myDate['Number'] == 'multiple':
         for i in myDate['Value']:
-            myTag = '<date certainty="{0}" era="ad">{1}</date>'.format(myDate['Certainty'], i.strip())
+            myTag = '<date certainty="{0}" era="ad">{1}</date>'.format(myDate['Certainty'], escapeValue(i.strip()))
             dateTagList.append(myTag)
     else:
-        myTag = '<date certainty="{0}" era="ad">{1}</date>'.format(myDate['Certainty'], myDate['Value'])
+        myTag = '<date certainty="{0}" era="ad">{1}</date>'.format(myDate['Certainty'], escapeValue(myDate['Value']))
         dateTagList.append(myTag)
     return '\n'.join(dateTagList)
 
@@ -200,7 +788,7 @@ def generateCenturyTags(inputCentury):
     result = []
     myList = sorted(inputCentury.split(';'))
     for i in myList:
-        result.append('<century certainty="exact" era="ad">{0}</century>'.format(i.strip()))
+        result.append('<century certainty="exact" era="ad">{0}</century>'.format(escapeValue(i.strip())))
     return result
 
 
@@ -209,7 +797,7 @@ def generateBrowseTerms(inputSubjects):
     result = []
     myList = inputSubjects.split(';')
     for i in myList:
-        result.append('<subject type="browse">{0}</subject>'.format(i.strip()))
+        result.append('<subject type="browse">{0}</subject>'.format(escapeValue(i.strip())))
     return '\n'.join(result)
 
 
@@ -220,45 +808,94 @@ def generateTopicalSubjects(**kwargs):
         if value != '':
             for i in value.split(';'):
                 if key == "pers":
-                    element = '<persName>{0}</persName>'.format(i.strip())
+                    element = '<persName>{0}</persName>'.format(escapeValue(i.strip()))
                 elif key == "corp":
-                    element = '<corpName>{0}</corpName>'.format(i.strip())
+                    element = '<corpName>{0}</corpName>'.format(escapeValue(i.strip()))
                 else:
-                    element = i.strip()
+                    element = escapeValue(i.strip())
                 result.append('<subject type="topical">{0}</subject>'.format(element))
     return '\n'.join(result)
 
 
 # generate block os XML relating to archival location
 def generateArchivalLocation(collection, **kwargs):
-    result = ['<title type="main">{0}</title>'.format(collection)]
+    result = ['<title type="main">{0}</title>'.format(escapeValue(collection))]
     for key, value in kwargs.items():
         if value != '':
-            result.append('<bibScope type="{0}">{1}</bibscope>'.format(key, value))
+            result.append('<bibScope type="{0}">{1}</bibscope>'.format(key, escapeValue(value)))
     return '\n'.join(result)
 
 
-# Prompts the user to enter the name of the UMAM or UMDM template or PID file and
+# Prompts the user to enter the name of the UMDM template or data file and
 # read that file, returning the contents.
 def loadFile(fileType):
     sourceFile = input("\nEnter the name of the %s file: " % (fileType))
     if fileType == 'data':
-        f = open(sourceFile, 'r').readlines()
+        f = readDataFile(sourceFile)
     else:
-        f = open(sourceFile, 'r').read()
+        f = open(sourceFile, 'r', encoding='utf-8').read()
     return(f, sourceFile)
 
 
+# Returns the path of an XML file in output/foxml, which for PID-named files in the sharded
+# layout includes the subdirectory for the PID's shard (created on first use).
+def foxmlFilePath(fileStem):
+    pidNumber = re.search(r'_(\d+)$', fileStem)
+    if foxmlLayout == 'sharded' and pidNumber:
+        directory = 'output/foxml/{0}/'.format(int(pidNumber.group(1)) // shardSize)
+        if directory not in shardDirectories:
+            os.makedirs(directory, exist_ok=True)
+            shardDirectories.add(directory)
+        return directory + fileStem + '.xml'
+    return 'output/foxml/' + fileStem + '.xml'
+
+shardDirectories = set()
+
+
+# The decoded lines of a data file, along with the encoding detected, a list of the lines
+# which could not be decoded, as (line number, description), and the byte offset of each line.
+class DataLines(list):
+
+    def __init__(self, lines, encoding, problems, offsets):
+        super().__init__(lines)
+        self.encoding = encoding
+        self.problems = problems
+        self.offsets = offsets
+
+
+# Reads the lines of a CSV data file, detecting its encoding (see sniffEncoding) and
+# normalizing the text (see normalizeLine). Lines that cannot be decoded do not stop the
+# read; they are listed in the result's problems, to be reported before any PIDs are used.
+def readDataFile(fileName):
+    encoding = sniffEncoding(fileName)
+    lines = []
+    offsets = array.array('q')
+    problems = []
+    lineProblems = []
+    with open(fileName, 'rb') as f:
+        for offset, line in iterPhysicalLines(f, encoding, problems=lineProblems):
+            lines.append(line)
+            offsets.append(offset)
+            if lineProblems:
+                problems.extend((len(lines), description) for offset, description in lineProblems)
+                del lineProblems[:]
+    return DataLines(lines, encoding, problems, offsets)
+
+
 # Creates a file containing the contents of the "content" string, named umd_[PID].xml,
-# with all files saved in dir 'output', and XML files in the sub-dir 'foxml'.
+# with all files saved in dir 'output', and XML files in the sub-dir 'foxml'
+# (see foxmlLayout). Returns the path of the file and the digest of its contents (see
+# digestAlgorithm), computed from the same bytes as are written, so the file is never read back.
 def writeFile(fileStem, content, extension):
     if extension == '.xml':
-        filePath = 'output/foxml/' + fileStem + extension
+        filePath = foxmlFilePath(fileStem)
     else:
         filePath = 'output/' + fileStem + extension
-    f = open(filePath, mode='w')
-    f.write(content)
+    data = content.encode('utf-8')
+    f = open(filePath, mode='wb')
+    f.write(data)
     f.close()
+    return filePath, hashlib.new(digestAlgorithm, data).hexdigest()
 
 
 # Select time format for runtime conversions (either minutes as decimal or ISO)
@@ -288,70 +925,166 @@ def timeFormatSelection():
     return convertTime
 
 
-# Performs series of find and replace operations to generate UMAM file from the template.
-def createUMAM(data, template, pid, rights):
-    timeStamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-    convertedRunTime = convertTime(data['DurationDerivatives'])
-    # initialize the output starting with the specified template file
-    outputfile = template
-    # create mapping of the metadata onto the UMAM XML template file
-    umamMap = {
-                '!!!PID!!!' : 					pid,
-                '!!!ContentModel!!!' : 			'UMD_VIDEO',
-                '!!!Status!!!' : 				rights['amInfoStatus'],
-                '!!!FileName!!!' : 				data['FileName'],
-                '!!!DateDigitized!!!' : 		data['DateDigitized'],
-                '!!!DigitizedByDept!!!' : 		'Digital Conversion and Media Reformatting',
-                '!!!ExtRefDescription!!!' : 	'Sharestream',
-                '!!!SharestreamURL!!!' : 		data['SharestreamURLs'],
-                '!!!DigitizedByPers!!!' : 		data['DigitizedByPers'],
-                '!!!DigitizationNotes!!!' : 	data['DigitizationNotes'],
-                '!!!AccessRights!!!' : 			rights['adminRightsAccess'],
-                '!!!MimeType!!!' : 				'audio/mpeg',
-                '!!!Compression!!!' : 			'lossy',
-                '!!!DurationDerivatives!!!' : 	str(convertedRunTime),
-                '!!!Mono/Stereo!!!' : 			data['Mono/Stereo'],
-                '!!!TrackFormat!!!' : 			data['TrackFormat'],
-                '!!!TimeStamp!!!' : 			timeStamp
-    }
-    # Carry out a find and replace for each line of the data mapping
-    # and convert ampersands in data into XML entities in the process
-    for k, v in umamMap.items():
-        outputfile = outputfile.replace(k, v.replace('&', '&amp;'))
-    return outputfile
-
-
-# Performs series of find and replace operations to generate UMDM file from the template.
-def createUMDM(data, template, summedRunTime, mets, pid, rights):
-    timeStamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-    # Initialize the output starting with the specified template file
-    outputfile = template
-    # Strip out trailing quotation marks from Dimensions field
-    if data['Dimensions'].endswith('"'):
-        data['Dimensions'] = data['Dimensions'][0:-1]
-    # Generate dating tags  
-    dateTagString = generateDateTag(data['DateCreated'], data['DateAttribute'], data['Century'])
-    # Generate browse terms
-    browseTermsString = generateBrowseTerms(data['RepositoryBrowse'])
-    # Generate topical subjects
-    topicalSubjects = generateTopicalSubjects(  pers=data['PersonalSubject'],
-                                                corp=data['CorpSubject'],
-                                                top=data['TopicalSubject']   )
-    # Generate MediaType XML Tags
-    mediaTypeString = generateMediaTypeTag(data['MediaType'], data['FormType'], data['Form'])
-    # Generate Archival Location Information Tags
-    archivalLocation = generateArchivalLocation(collection=data['ArchivalCollection'],
-                                                series=data['series'],
-                                                subseries=data['subseries'],
-                                                box=data['box'],
-                                                item=data['item'],
-                                                accession=data['accession'] )
-
-    # Insert the RELS-METS section compiled from the UMAM files
-    outputfile = outputfile.replace('!!!INSERT_METS_HERE!!!', mets)     # Insert the METS
-    outputfile = stripAnchors(outputfile)                               # Strip out anchor points
-    # XML tags with which to wrap the CSV data
-    XMLtags = {
+# Reads a template or METS snippet file, each file only once.
+@functools.lru_cache(maxsize=None)
+def readTemplateFile(fileName):
+    return open(fileName, 'r', encoding='utf-8').read()
+
+
+# Splits a template into its literal text and the !!!Anchor!!! points to be filled in, so that
+# each file is rendered in a single pass (see renderTemplate) rather than by searching the
+# whole template once for every anchor. The anchors are the odd-numbered parts of the result.
+def compileTemplate(text):
+    return Template(anchorPattern.split(text))
+
+anchorPattern = re.compile(r'(!!![^!\n]+!!!)')
+
+
+# The parts of a compiled template, along with the set of anchors it has, so that only the
+# fields the template actually uses are computed (see fillFields).
+class Template(list):
+
+    def __init__(self, parts):
+        super().__init__(parts)
+        self.anchors = frozenset(parts[1::2])
+
+
+# Fills in the anchors of a compiled template with their values from the mapping. Anchors
+# that are not in the mapping are left in place.
+def renderTemplate(parts, mapping):
+    result = parts[:]
+    for i in range(1, len(parts), 2):
+        result[i] = mapping.get(parts[i], parts[i])
+    return ''.join(result)
+
+
+# Loads and compiles the UMAM template of each kind of media in a registry like umamTemplates,
+# returning a copy of the registry with each entry's compiled template added as 'parts'.
+def loadUmamTemplates(registry=umamTemplates):
+    umam = {}
+    for kind, entry in registry.items():
+        umam[kind] = dict(entry, parts=compileTemplate(readTemplateFile(entry['file'])))
+        print('Loaded {0} UMAM template {1} ({2}, {3}).'.format(kind, entry['file'], entry['contentModel'],
+                                                                entry['mimeType']))
+    return umam
+
+
+# Picks the UMAM template for a row, by the first kind of media whose words appear in the row's
+# MediaType or Format. A UMAM row with both columns empty takes its media from the UMDM row of
+# its object, if given, and a row matching no kind gets the default.
+def chooseUmamTemplate(umam, row, umdmRow=None):
+    for r in (row, umdmRow):
+        if r is None:
+            continue
+        media = ' '.join((r.get('MediaType'), r.get('Format'))).lower()
+        if media.strip() == '':
+            continue
+        for entry in umam.values():
+            if any(word in media for word in entry['match']):
+                return entry
+        break
+    return umam[defaultMediaKind]
+
+
+# Template fields, as used in umamFields and umdmFields below: a field is the tuple of the data
+# columns it reads and a function computing its value from the row ('x') and the details of the
+# object being generated ('obj': PID, rights scheme, timestamp...). Data values are escaped
+# for XML as they are read.
+def columnField(column, optional=False):
+    if optional:            # columns which only some data files have
+        return ((column,), lambda x, obj: escapeValue(x.get(column)))
+    return ((column,), lambda x, obj: escapeValue(x[column]))
+
+def objectField(name):
+    return ((), lambda x, obj: obj[name])
+
+def constantField(value):
+    return ((), lambda x, obj: value)
+
+
+# Strips out trailing quotation marks (inches) from a Dimensions value
+def trimDimensions(dimensions):
+    if dimensions.endswith('"'):
+        dimensions = dimensions[0:-1]
+    return dimensions
+
+
+# Mapping of the metadata onto the anchors of the UMAM templates
+umamFields = {
+                '!!!PID!!!' :                   objectField('pid'),
+                '!!!ContentModel!!!' :          ((), lambda x, obj: obj['template']['contentModel']),
+                '!!!Status!!!' :                ((), lambda x, obj: obj['rights']['amInfoStatus']),
+                '!!!FileName!!!' :              columnField('FileName'),
+                '!!!DateDigitized!!!' :         columnField('DateDigitized'),
+                '!!!DigitizedByDept!!!' :       constantField('Digital Conversion and Media Reformatting'),
+                '!!!ExtRefDescription!!!' :     constantField('Sharestream'),
+                '!!!SharestreamURL!!!' :        columnField('SharestreamURLs'),
+                '!!!DigitizedByPers!!!' :       columnField('DigitizedByPers'),
+                '!!!DigitizationNotes!!!' :     columnField('DigitizationNotes'),
+                '!!!AccessRights!!!' :          ((), lambda x, obj: obj['rights']['adminRightsAccess']),
+                '!!!MimeType!!!' :              ((), lambda x, obj: obj['template']['mimeType']),
+                '!!!Compression!!!' :           constantField('lossy'),
+                '!!!DurationDerivatives!!!' :   (('DurationDerivatives',),
+                                                 lambda x, obj: str(convertTime(x['DurationDerivatives']))),
+                '!!!Mono/Stereo!!!' :           columnField('Mono/Stereo'),
+                '!!!TrackFormat!!!' :           columnField('TrackFormat'),
+                '!!!Language!!!' :              columnField('Language', optional=True),
+                '!!!Color!!!' :                 columnField('Color', optional=True),
+                '!!!AspectRatio!!!' :           columnField('AspectRatio', optional=True),
+                '!!!FrameRate!!!' :             columnField('FrameRate', optional=True),
+                '!!!TimeStamp!!!' :             objectField('timeStamp')
+}
+
+# Mapping of the metadata onto the anchors of the UMDM template (and of the METS inserted in it)
+umdmFields = {
+                '!!!PID!!!' :                   objectField('pid'),
+                '!!!ContentModel!!!' :          constantField('UMD_VIDEO'),
+                '!!!Status!!!' :                ((), lambda x, obj: obj['rights']['doInfoStatus']),
+                '!!!Title!!!' :                 columnField('Title'),
+                '!!!AlternateTitle!!!' :        columnField('AlternateTitle'),
+                '!!!Contributor!!!' :           columnField('Contributor'),
+                '!!!Creator!!!' :               columnField('Creator'),
+                '!!!Provider!!!' :              columnField('Provider/Publisher'),
+                '!!!Identifier!!!' :            columnField('Identifier'),
+                '!!!Description/Summary!!!' :   columnField('Description/Summary'),
+                '!!!AccessDescription!!!' :     columnField('Rights'),
+                '!!!CopyrightHolder!!!' :       columnField('CopyrightHolder'),
+                '!!!MediaType/Form!!!' :        (('MediaType', 'FormType', 'Form'),
+                                                 lambda x, obj: generateMediaTypeTag(x['MediaType'], x['FormType'],
+                                                                                     x['Form'])),
+                '!!!Continent!!!' :             columnField('Continent'),
+                '!!!Country!!!' :               columnField('Country'),
+                '!!!Region/State!!!' :          columnField('Region/State'),
+                '!!!Settlement/City!!!' :       columnField('Settlement/City'),
+                '!!!InsertDateHere!!!' :        (('DateCreated', 'DateAttribute', 'Century'),
+                                                 lambda x, obj: generateDateTag(x['DateCreated'], x['DateAttribute'],
+                                                                                x['Century'])),
+                '!!!Language!!!' :              columnField('Language'),
+                '!!!Dimensions!!!' :            (('Dimensions',),
+                                                 lambda x, obj: escapeValue(trimDimensions(x['Dimensions']))),
+                '!!!DurationMasters!!!' :       ((), lambda x, obj: str(round(obj['summedRunTime'], 2))),
+                '!!!Format!!!' :                columnField('Format'),
+                '!!!RepositoryBrowse!!!' :      (('RepositoryBrowse',),
+                                                 lambda x, obj: generateBrowseTerms(x['RepositoryBrowse'])),
+                '!!!TopicalSubjects!!!' :       (('PersonalSubject', 'CorpSubject', 'TopicalSubject'),
+                                                 lambda x, obj: generateTopicalSubjects(pers=x['PersonalSubject'],
+                                                                                        corp=x['CorpSubject'],
+                                                                                        top=x['TopicalSubject'])),
+                '!!!ArchivalLocation!!!' :      (('ArchivalCollection', 'series', 'subseries', 'box', 'item',
+                                                  'accession'),
+                                                 lambda x, obj: generateArchivalLocation(
+                                                                    collection=x['ArchivalCollection'],
+                                                                    series=x['series'],
+                                                                    subseries=x['subseries'],
+                                                                    box=x['box'],
+                                                                    item=x['item'],
+                                                                    accession=x['accession'])),
+                '!!!CollectionPID!!!' :         constantField('umd:3392'),
+                '!!!TimeStamp!!!' :             objectField('timeStamp')
+}
+
+# XML tags with which to wrap the UMDM data (an empty value gets rid of the anchor point)
+umdmTags = {
             '!!!ContentModel!!!' : 	{			'open' : '<type>',
                                     			'close' : '</type>'	},
             '!!!Status!!!' : {					'open' : '<status>',
@@ -394,307 +1127,999 @@ def createUMDM(data, template, summedRunTime, mets, pid, rights):
                                   				'close' : '</bibRef>'}
             }
 
-    # Create mapping of the metadata onto the UMDM XML template file
-    umdmMap = {
-                '!!!PID!!!' :           		pid,
-                '!!!ContentModel!!!' : 			'UMD_VIDEO',
-                '!!!Status!!!' : 				rights['doInfoStatus'],
-                '!!!Title!!!' : 				data['Title'],
-                '!!!AlternateTitle!!!' : 		data['AlternateTitle'],
-                '!!!Contributor!!!' : 			data['Contributor'],
-                '!!!Creator!!!' : 				data['Creator'],
-                '!!!Provider!!!' :  			data['Provider/Publisher'],
-                '!!!Identifier!!!' :  			data['Identifier'],
-                '!!!Description/Summary!!!' : 	data['Description/Summary'],
-                '!!!AccessDescription!!!' : 	data['Rights'],
-                '!!!CopyrightHolder!!!' : 		data['CopyrightHolder'],
-                '!!!MediaType/Form!!!' : 		mediaTypeString,
-                '!!!Continent!!!' : 			data['Continent'],
-                '!!!Country!!!' : 				data['Country'],
-                '!!!Region/State!!!' : 			data['Region/State'],
-                '!!!Settlement/City!!!' : 		data['Settlement/City'],
-                '!!!InsertDateHere!!!' : 		dateTagString,
-                '!!!Language!!!' : 				data['Language'],
-                '!!!Dimensions!!!' : 			data['Dimensions'],
-                '!!!DurationMasters!!!' : 		str(round(summedRunTime, 2)),
-                '!!!Format!!!' : 		        data['Format'],
-                '!!!RepositoryBrowse!!!' : 		browseTermsString,
-                '!!!TopicalSubjects!!!' :       topicalSubjects,
-                '!!!ArchivalLocation!!!' :      archivalLocation,
-                '!!!CollectionPID!!!' : 		'umd:3392',
-                '!!!TimeStamp!!!' : 			timeStamp
-    }
-
-    # Carry out a find and replace for each line of the data mapping
-    # and convert ampersands to XML entities in the process
-    for k, v in umdmMap.items():
-        if k in XMLtags.keys(): # If there is an XML tag available
-            if v != '':         # and if the data point is not empty
-                # wrap the data point with the XML tag and insert it in the template
-                myTag = XMLtags[k]['open'] + v.replace('&', '&amp;') + XMLtags[k]['close']
-                outputfile = outputfile.replace(k, myTag)
-            else: # if the data is empty, get rid of the anchor point
-                outputfile = outputfile.replace(k, '')
-        else: # but if there is no xml tag available, simply replace anchor with value
-            outputfile = outputfile.replace(k, v.replace('&', '&amp;'))
-    return outputfile
+# Data columns read by the generator itself rather than through a template field: for the
+# arrangement of the rows, the duplicate checks, the choice of UMAM template and the runtime
+# summed into each UMDM
+generatorColumns = ('XMLType', 'Identifier', 'FileName', 'MediaType', 'Format', 'DurationDerivatives')
+
+
+# Works out the values of the anchors of a template from its fields (see umamFields), computing
+# only those fields whose anchor is in the template. A value with an XML tag in 'tags' is
+# wrapped in it if the value is not empty, and removed along with its anchor if it is.
+def fillFields(fields, anchors, x, obj, tags={}):
+    values = {}
+    for anchor in anchors:
+        field = fields.get(anchor)
+        if field is None:
+            continue
+        value = field[1](x, obj)
+        if anchor in tags:
+            if value != '':
+                value = tags[anchor]['open'] + value + tags[anchor]['close']
+        values[anchor] = value
+    return values
+
+
+# Generates a UMAM file from the template entry chosen for the row (see chooseUmamTemplate).
+def createUMAM(data, template, pid, rights):
+    obj = {'pid' : pid, 'rights' : rights, 'template' : template,
+           'timeStamp' : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")}
+    parts = template['parts']
+    return embedDatastreamDigests(renderTemplate(parts, fillFields(umamFields, parts.anchors, data, obj)))
+
+
+# Generates a UMDM file from the template, with the METS of its parts inserted.
+def createUMDM(data, template, summedRunTime, mets, pid, rights):
+    obj = {'pid' : pid, 'rights' : rights, 'summedRunTime' : summedRunTime,
+           'timeStamp' : datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")}
+    anchors = template.anchors
+    # The RELS-METS section compiled from the UMAM files, with the anchor points used in creating
+    # it stripped out, has anchors of its own (timestamps, collection PID) to be filled in as well
+    if '!!!INSERT_METS_HERE!!!' in anchors:
+        mets = compileTemplate(stripAnchors(mets))
+        anchors = anchors | mets.anchors
+    values = fillFields(umdmFields, anchors, data, obj, umdmTags)
+    if '!!!INSERT_METS_HERE!!!' in anchors:
+        values['!!!INSERT_METS_HERE!!!'] = renderTemplate(mets, values)
+    return embedDatastreamDigests(renderTemplate(template, values))
 
 
 # Initiates a new METS snippet for use in a UMDM file
 def createMets():
-    metsFile = open('mets.xml', 'r').read()
+    metsFile = readTemplateFile('mets.xml')
     return(metsFile)
 
 
 # Updates a METS record with UMAM info
 def updateMets(partNumber, mets, fileName, pid):
     id = str(partNumber + 1)   # first item(s) are collection PIDs
-    metsSnipA = open('metsA.xml', 'r').read() + '!!!Anchor-A!!!'
-    metsSnipB = open('metsB.xml', 'r').read() + '!!!Anchor-B!!!'
-    metsSnipC = open('metsC.xml', 'r').read() + '!!!Anchor-C!!!'
+    metsSnipA = readTemplateFile('metsA.xml') + '!!!Anchor-A!!!'
+    metsSnipB = readTemplateFile('metsB.xml') + '!!!Anchor-B!!!'
+    metsSnipC = readTemplateFile('metsC.xml') + '!!!Anchor-C!!!'
     mets = mets.replace('!!!Anchor-A!!!', metsSnipA)
     mets = mets.replace('!!!Anchor-B!!!', metsSnipB)
     mets = mets.replace('!!!Anchor-C!!!', metsSnipC)
-    mets = mets.replace('!!!FileName!!!', fileName)
+    mets = mets.replace('!!!FileName!!!', escapeValue(fileName))
     mets = mets.replace('!!!ID!!!', id)
     mets = mets.replace('!!!PID!!!', pid)
     mets = mets.replace('!!!Order!!!', str(partNumber))
     return mets
 
 
+# Fills in the contentDigest of each inline XML datastream of a rendered FOXML file, if
+# embedDigests is on, with the digest of the datastream's XML content.
+def embedDatastreamDigests(document):
+    if not embedDigests:
+        return document
+    def fill(m):
+        digest = hashlib.new(digestAlgorithm, m.group(2).encode('utf-8')).hexdigest()
+        return '<foxml:contentDigest DIGEST="{0}" TYPE="{1}"/>{2}{3}'.format(
+               digest, fedoraDigestTypes[digestAlgorithm], m.group(1), m.group(2))
+    return inlineDatastreamPattern.sub(fill, document)
+
+inlineDatastreamPattern = re.compile(r'<foxml:contentDigest DIGEST="none" TYPE="DISABLED"/>(\s*<foxml:xmlContent>)'
+                                     r'(.*?)(?=</foxml:xmlContent>)', re.S)
+
+
 # Strips out the anchor points used in creating the METS 
 def stripAnchors(target):
     f = re.sub(r"\n\s*!!!Anchor-[ABC]!!!", "", target)
     return f
 
 
-def main():
-    
-    # Initialize needed variables and lists
-    mets = ""		# empty string for compiling METS record
-    objectGroups = 0    # counter for UMDM plus UMAM(s) as a group
-    objectParts = 0     # counter for the number of UMAM parts for each UMDM
-    summedRunTime = 0   # variable to hold sum of constituent UMAM runtimes for UMDM
-    pidCounter = 0      # counter for coordinating PID list with data lines from CSV
-    filesWritten = 0    # counter for file outputs
-    umdmList = []	# list for compiling list of UMDM pids
-    outputFiles = []    # list for compiling list of all pids written
-    summaryList = []    # list for compiling list of PIDs and Object IDs
-    global convertTime
-    
-    # Create a timeStamp for these operations
-    timeStamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-    
-    # Initiate the program, recording the timestamp and name of user
-    greeting()
+# Opens the SQLite manifest of all generation runs, creating its tables and indexes if needed.
+# Each batch gets one row in 'batches' and one row in 'records' for every FOXML file written.
+def openManifest(path=manifestFile):
+    manifest = sqlite3.connect(path)
+    manifest.executescript('''
+        CREATE TABLE IF NOT EXISTS batches (
+            batch       TEXT PRIMARY KEY,
+            created     TEXT,
+            operator    TEXT,
+            dataFile    TEXT,
+            arrangement TEXT,
+            settings    TEXT
+        );
+        CREATE TABLE IF NOT EXISTS records (
+            batch       TEXT NOT NULL,
+            seq         INTEGER,
+            row         INTEGER,
+            pid         TEXT NOT NULL,
+            xmlType     TEXT,
+            identifier  TEXT,
+            fileName    TEXT,
+            parentPid   TEXT,
+            path        TEXT,
+            digest      TEXT
+        );
+        CREATE INDEX IF NOT EXISTS recordsByPid ON records (pid);
+        CREATE INDEX IF NOT EXISTS recordsByIdentifier ON records (identifier);
+        CREATE INDEX IF NOT EXISTS recordsByFileName ON records (fileName);
+        CREATE INDEX IF NOT EXISTS recordsByParent ON records (parentPid);
+        CREATE INDEX IF NOT EXISTS recordsByBatch ON records (batch, seq);
+    ''')
+    return manifest
+
+
+# Registers a new batch in the manifest, along with the settings used to generate it.
+def startBatch(manifest, batch, operator, dataFile, arrangement, settings):
+    manifest.execute('INSERT INTO batches VALUES (?, ?, ?, ?, ?, ?)',
+                     (batch, datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                      operator, dataFile, arrangement, json.dumps(settings)))
+
+
+# Adds one written FOXML file to the manifest. The seq value is the file's position in the
+# PID list (i.e. the order of the links file), row is the line of the data file it came from.
+def recordFile(manifest, batch, seq, row, data, pid, xmlType, parentPid, filePath, digest):
+    manifest.execute('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (batch, seq, row, pid, xmlType, data['Identifier'], data['FileName'],
+                      parentPid, filePath, digest))
+
+
+# Exports the classic summary files (pids.txt, links.txt and UMDMpids.txt) for a batch
+# from the manifest, along with the index of FOXML files (foxml_index.txt) and their
+# checksums (checksums.txt), returning the number of files written.
+def exportSummaries(manifest, batch):
+    manifest.commit()
+    records = manifest.execute('SELECT pid, xmlType FROM records WHERE batch = ? ORDER BY rowid',
+                               (batch,)).fetchall()
+
+    print('\nWriting pidlist file as pids.txt...')
+    writeFile('pids', '\n'.join(pid for pid, xmlType in records), '.txt')
+
+    print('Writing summary file as links.txt...')
+    summaryList = []
+    for identifier, xmlType, pid in manifest.execute('SELECT identifier, xmlType, pid FROM records ' +
+                                                     'WHERE batch = ? ORDER BY seq', (batch,)):
+        if xmlType == 'UMDM':
+            link = '"{0}","{1}","{2}","http://digital.lib.umd.edu/video?pid={2}"'.format(identifier,
+                                                                                         xmlType, pid)
+        else:
+            link = '"{0}","{1}","{2}"'.format(identifier, xmlType, pid)
+        summaryList.append(link)
+    writeFile('links', '\n'.join(summaryList), '.txt')
+
+    print('Writing list of UMDM files as UMDMpids.txt...')
+    writeFile('UMDMpids', '\n'.join(pid for pid, xmlType in records if xmlType == 'UMDM'), '.txt')
+
+    print('Writing index of FOXML files as foxml_index.txt...')
+    index = manifest.execute('SELECT pid, path FROM records WHERE batch = ? ORDER BY rowid', (batch,))
+    writeFile('foxml_index', '\n'.join('{0}\t{1}'.format(pid, path) for pid, path in index), '.txt')
+
+    # In the format of sha256sum and the like, so that 'sha256sum -c output/checksums.txt' (run
+    # from the main directory) verifies the batch
+    print('Writing {0} checksums of FOXML files as checksums.txt...'.format(digestAlgorithm))
+    checksums = manifest.execute('SELECT digest, path FROM records WHERE batch = ? ORDER BY rowid', (batch,))
+    writeFile('checksums', ''.join('{0}  {1}\n'.format(digest, path) for digest, path in checksums), '.txt')
+    return 5
+
+
+# Brings the exported foxml_index.txt and checksums.txt up to date with the files rewritten by
+# a regenerate batch, replacing the entries of the regenerated PIDs with their new paths and
+# digests so that the exports still verify. The entries of other files are left as they are.
+def updateSummaries(manifest, batch):
+    records = manifest.execute('SELECT pid, path, digest FROM records WHERE batch = ?', (batch,)).fetchall()
+    paths = {pid : path for pid, path, digest in records}
+    digests = {path : digest for pid, path, digest in records}
+    moved = {}          # old path -> new path of each regenerated PID listed in the index
+    if os.path.exists('output/foxml_index.txt'):
+        lines = open('output/foxml_index.txt', 'r', encoding='utf-8').read().split('\n')
+        for i, line in enumerate(lines):
+            pid, tab, path = line.partition('\t')
+            if pid in paths:
+                moved[path] = paths[pid]
+                lines[i] = '{0}\t{1}'.format(pid, paths[pid])
+        writeFile('foxml_index', '\n'.join(lines), '.txt')
+    if os.path.exists('output/checksums.txt'):
+        lines = open('output/checksums.txt', 'r', encoding='utf-8').read().splitlines()
+        updated = 0
+        for i, line in enumerate(lines):
+            digest, sep, path = line.partition('  ')
+            path = moved.get(path, path)
+            if path in digests:
+                lines[i] = '{0}  {1}'.format(digests[path], path)
+                updated += 1
+        writeFile('checksums', ''.join(line + '\n' for line in lines), '.txt')
+        print('Updated {0} entries of output/checksums.txt and foxml_index.txt.'.format(updated))
+
+
+# Checks every row of the data for Identifiers and FileNames that were already used, either
+# earlier in this data file or in a previous batch recorded in the manifest, and returns a
+# list of the conflicts found. Only the keys of the current batch are held in memory; the
+# history is looked up through the manifest's indexes.
+def findDuplicates(dataFile, dataFileArrangement, manifest):
+    conflicts = []
+    seen = {}
+    columns = {'Identifier' : 'identifier', 'FileName' : 'fileName'}
+    for x in readRows(dataFile):
+        if dataFileArrangement == 'S':      # single rows produce both a UMDM and a UMAM
+            xmlTypes = ('UMDM', 'UMAM')
+        else:
+            xmlTypes = (x['XMLType'],)
+        for xmlType in xmlTypes:
+            for field in uniqueFields.get(xmlType, ()):
+                value = x[field].strip()
+                if value == '':
+                    continue
+                key = (xmlType, field, value)
+                if key in seen:
+                    conflicts.append('Line {0}: {1} {2} "{3}" is already used on line {4}'.format(
+                                     x.line, xmlType, field, value, seen[key]))
+                    continue
+                seen[key] = x.line
+                previous = manifest.execute('SELECT batch, pid FROM records WHERE {0} = ? AND xmlType = ? '
+                                            'LIMIT 1'.format(columns[field]), (value, xmlType)).fetchone()
+                if previous:
+                    conflicts.append('Line {0}: {1} {2} "{3}" was already generated as {4} in batch {5}'.format(
+                                     x.line, xmlType, field, value, previous[1], previous[0]))
+    return conflicts
+
+
+# Prints the lines of the data file that could not be decoded and asks whether to carry on
+# (with the bad characters replaced) before any PIDs are requested.
+def reportDecodeProblems(dataFile):
+    print('\nThe data file was read as {0}.'.format(dataFile.encoding))
+    if not dataFile.problems:
+        return
+    print('Found {0} line(s) that are not valid {1}:'.format(len(dataFile.problems), dataFile.encoding))
+    for lineNumber, description in dataFile.problems:
+        print('  Line {0}: {1}'.format(lineNumber, description))
+    choice = input('\nContinue anyway? Enter Y to continue or N to exit: ')
+    while choice not in ('Y', 'N'):
+        choice = input('You must enter Y or N: ')
+    if choice == 'N':
+        print('Exiting program.')
+        quit()
+
+
+# Prints the duplicate report and asks whether to carry on before any PIDs are requested.
+def reportDuplicates(conflicts):
+    if not conflicts:
+        print('\nNo duplicate Identifiers or FileNames found.')
+        return
+    print('\nFound {0} duplicate Identifier(s)/FileName(s):'.format(len(conflicts)))
+    for c in conflicts:
+        print('  ' + c)
+    choice = input('\nContinue anyway? Enter Y to continue or N to exit: ')
+    while choice not in ('Y', 'N'):
+        choice = input('You must enter Y or N: ')
+    if choice == 'N':
+        print('Exiting program.')
+        quit()
+
+
+# Returns the anchors a UMDM or UMAM template has, including those of the METS which are
+# filled in along with the template's own (see createUMDM).
+def templateAnchors(template):
+    anchors = template.anchors
+    if '!!!INSERT_METS_HERE!!!' in anchors:
+        anchors = anchors | compileTemplate(stripAnchors(updateMets(1, createMets(), '', ''))).anchors
+    return anchors
+
+
+# Returns the data columns read in filling in the UMAM and UMDM templates, or by the generator itself.
+def templateColumns(umam, umdm):
+    columns = set(generatorColumns)
+    for parts, fields in [(entry['parts'], umamFields) for entry in umam.values()] + [(umdm, umdmFields)]:
+        for anchor in templateAnchors(parts):
+            if anchor in fields:
+                columns.update(fields[anchor][0])
+    return columns
+
+
+# Prints, for each template, the anchors with no mapping (which are left in the output as they
+# are) and the mapped fields it does not use (which are not computed at all), before any rows
+# are processed.
+def reportTemplateCoverage(umam, umdm, umdmName):
+    templates = [(entry['file'], entry['parts'], umamFields) for entry in umam.values()]
+    templates.append((umdmName, umdm, umdmFields))
+    print()
+    for name, parts, fields in templates:
+        anchors = templateAnchors(parts)
+        unmapped = sorted(a for a in anchors if a not in fields and a != '!!!INSERT_METS_HERE!!!')
+        unused = sorted(a for a in fields if a not in anchors)
+        print('Template {0}: {1} of {2} anchors mapped.'.format(name, len(anchors) - len(unmapped), len(anchors)))
+        if unmapped:
+            print('  Not mapped, left in the output: ' + ', '.join(unmapped))
+        if unused:
+            print('  Mapped but not in the template: ' + ', '.join(unused))
+
+
+# Prints the columns of the data file which none of the templates read.
+def reportUnusedColumns(dataFile, umam, umdm):
+    columns = templateColumns(umam, umdm)
+    unused = [c for c in next(csv.reader(dataFile), []) if c.strip() != '' and c not in columns]
+    if unused:
+        print('Data columns not used by the templates: ' + ', '.join(unused))
+    else:
+        print('Every data column is used by the templates.')
+
+
+# Looks up each PID, Identifier or FileName given on the command line in the manifest,
+# printing every matching file along with the batch that produced it.
+def lookupRecords(*terms):
+    manifest = openManifest()
+    query = '''SELECT r.pid, r.xmlType, r.identifier, r.fileName, r.parentPid, r.path, r.digest,
+                      b.batch, b.dataFile, b.operator, b.settings
+               FROM records r JOIN batches b ON r.batch = b.batch
+               WHERE r.rowid IN (SELECT rowid FROM records WHERE pid = :term
+                                 UNION SELECT rowid FROM records WHERE identifier = :term
+                                 UNION SELECT rowid FROM records WHERE fileName = :term)
+               ORDER BY b.batch, r.seq'''
+    for term in terms:
+        results = manifest.execute(query, {'term' : term}).fetchall()
+        print('\n{0}: {1} matching file(s)'.format(term, len(results)))
+        for r in results:
+            print('  {0} {1} Identifier={2} FileName={3} parent={4}'.format(*r[0:5]))
+            # Batches from before digestAlgorithm was a setting always used SHA-256
+            algorithm = json.loads(r[10]).get('digestAlgorithm', 'sha256')
+            print('      {0} ({1} {2})'.format(r[5], algorithm, r[6]))
+            print('      batch {0} from {1}, run by {2}'.format(*r[7:10]))
+    manifest.close()
+
+
+# Generates the files for one object of multi-row data: the group of rows holds the UMDM row
+# followed by its UMAM rows, all with PIDs attached. Each UMAM is written and added to the
+# METS, then the UMDM is completed with the METS and the summed runtime of the parts. Every
+# file is recorded in the manifest under the given batch. Returns the number of files written.
+def generateGroup(manifest, batch, group, umam, umdm, rights):
+    umdmRow = group[0]
+    mets = createMets()
+    summedRunTime = 0
+    for objectParts, x in enumerate(group[1:]):
+        
+        # Print summary info to the screen
+        print('Writing UMAM...', end=' ')
+        
+        # Create UMAM, convert PID for use as filename, write the file
+        myFile = createUMAM(x, chooseUmamTemplate(umam, x, umdmRow), x.pid, rights)
+        convertedDerivativeRunTime = convertTime(x['DurationDerivatives'])
+        fileStem = x.pid.replace(':', '_').strip()
+        print('Part {0}: UMAM = {1}'.format(objectParts, fileStem))
+        filePath, digest = writeFile(fileStem, myFile, '.xml')
+        recordFile(manifest, batch, x.seq, x.row, x, x.pid, 'UMAM', umdmRow.pid, filePath, digest)
+        summedRunTime += convertedDerivativeRunTime
+        
+        # Update the running METS record for use in finishing the UMDM
+        mets = updateMets(objectParts + 1, mets, x['FileName'], x.pid)
     
-    # Load CSV data
-    dataFile, fileName = loadFile('data')
+    # Finish the UMDM with the METS for all of its parts
+    myFile = createUMDM(umdmRow, umdm, summedRunTime, mets, umdmRow.pid, rights)
+    fileStem = umdmRow.pid.replace(':', '_').strip()    # convert ':' to '_' in PID for use in filename
+    filePath, digest = writeFile(fileStem, myFile, '.xml')      # Write the file
     
-    # Parse loaded data and request user input to calculate num of PIDS needed
-    pidsNeeded, dataFileArrangement = analyzeDataFile(dataFile)
+    # Print summary info to the screen
+    print('Creating UMDM for object with {0} parts...'.format(len(group) - 1), end=" ")
+    print('\nTotal runtime of all parts = {0}.'.format(str(summedRunTime)))
+    print('UMDM = {0}'.format(fileStem))
     
-    # Request PIDs from the server OR load PIDs from previously saved file.
-    pidFile = getPids(pidsNeeded)
+    # Record the UMDM file in the manifest
+    recordFile(manifest, batch, umdmRow.seq, umdmRow.row, umdmRow, umdmRow.pid, 'UMDM', None,
+               filePath, digest)
+    return len(group)
+
+
+# Generates the UMAM and UMDM for one row of single-row data, writing both files. This runs in
+# a worker process: the row arrives as a tuple of values and is rebuilt with the row type,
+# templates and rights scheme the workers share through singleRowContext. Returns the paths
+# and digests of the two files, along with the runtime of the UMAM.
+def generateSingleRowObject(task):
+    values, row, umdmPid, umamPid = task
+    x = singleRowContext['rowType'](values, row)
+    rights = singleRowContext['rights']
     
-    # Parse the XML PID file (either local or from the server) to get list of PIDs
-    pidList = parsePids(pidFile)
+    # Create UMAM, convert PID for use as filename, write the file
+    umamFile = createUMAM(x, chooseUmamTemplate(singleRowContext['umam'], x), umamPid, rights)
+    runTime = convertTime(x['DurationDerivatives'])
+    umamPath, umamDigest = writeFile(umamPid.replace(':', '_').strip(), umamFile, '.xml')
     
-    # Check whether the loaded file has enough PIDs, abort if not enough
-    if len(pidList) < pidsNeeded:
-        print('Not enough PIDs for your dataset!')
-        print('Please reserve additional PIDs from the server and try again.')
-        print('Exiting program.')
-        quit()
+    # Create the METS for the single part, then the UMDM
+    mets = updateMets(1, createMets(), x['FileName'], umamPid)
+    umdmFile = createUMDM(x, singleRowContext['umdm'], runTime, mets, umdmPid, rights)
+    umdmPath, umdmDigest = writeFile(umdmPid.replace(':', '_').strip(), umdmFile, '.xml')
+    return umamPath, umamDigest, umdmPath, umdmDigest, runTime
+
+
+# Asks the server whether an object exists, returning 'present', 'missing', 'mismatched' (the
+# object exists, but its label is not that of the expected XMLType) or 'error', plus a detail.
+def probePid(session, baseUrl, pid, xmlType):
+    try:
+        response = session.get(baseUrl + '/get/{0}?xml=true'.format(pid), timeout=networkTimeout)
+    except requests.RequestException as e:
+        return 'error', '{0}: {1}'.format(type(e).__name__, e)
+    if response.status_code == 404 or (response.status_code == 500 and 'ObjectNotFound' in response.text):
+        return 'missing', str(response.status_code)
+    if response.status_code != 200:
+        return 'error', 'HTTP {0} {1}'.format(response.status_code, response.reason)
+    label = re.search('<objLabel>(.*?)</objLabel>', response.text, re.DOTALL)
+    if label and label.group(1).strip() != expectedLabels[xmlType]:
+        return 'mismatched', 'expected "{0}", found "{1}"'.format(expectedLabels[xmlType], label.group(1).strip())
+    return 'present', ''
+
+
+# Reads the PIDs of a run from its summary files, returning a list of (PID, XMLType) pairs.
+def readSummaryPids(summaryDir):
+    pids = [p.strip() for p in open(os.path.join(summaryDir, 'pids.txt'), 'r').read().splitlines() if p.strip()]
+    umdmPids = set(p.strip() for p in open(os.path.join(summaryDir, 'UMDMpids.txt'), 'r').read().splitlines())
+    return [(p, 'UMDM' if p in umdmPids else 'UMAM') for p in pids]
+
+
+# Reads the FOXML index written with a run's summary files into a dict of paths by PID.
+def readFoxmlIndex(summaryDir):
+    index = {}
+    indexFile = os.path.join(summaryDir, 'foxml_index.txt')
+    if os.path.exists(indexFile):
+        for line in open(indexFile, 'r', encoding='utf-8').read().splitlines():
+            pid, path = line.split('\t', 1)
+            index[pid] = path
+    return index
+
+
+# Finds the FOXML file generated for a PID, from the run's index or else the manifest.
+def foxmlPath(index, manifest, pid):
+    if pid in index:
+        return index[pid]
+    row = manifest.execute('SELECT path FROM records WHERE pid = ? AND path IS NOT NULL ' +
+                           'ORDER BY rowid DESC LIMIT 1', (pid,)).fetchone()
+    if row:
+        return row[0]
+    return foxmlFilePath(pid.replace(':', '_').strip())
+
+
+# Checks which of the PIDs in a run's summary files (pids.txt and UMDMpids.txt) already exist
+# on the server, probing them concurrently over one pooled session. Writes lists of the present,
+# missing and mismatched PIDs, plus a PID file of the missing PIDs that can be loaded to generate
+# them again and a list of their FOXML files for ingest.
+def reconcile(summaryDir='output'):
+    pids = readSummaryPids(summaryDir)
+    print('\nLoaded {0} PIDs from the summary files in {1}/.'.format(len(pids), summaryDir))
+    baseUrl = chooseServer('check PIDs')
+    session = createSession(getCredentials())
+    results = {'present' : [], 'missing' : [], 'mismatched' : [], 'error' : []}
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(networkWorkers) as executor:
+        futures = [executor.submit(probePid, session, baseUrl, pid, xmlType) for pid, xmlType in pids]
+        for (pid, xmlType), future in zip(pids, futures):
+            outcome, detail = future.result()
+            results[outcome].append((pid, xmlType, detail))
+    print('Checked {0} PIDs in {1:.1f} seconds.'.format(len(pids), time.time() - start))
+
+    for outcome, found in results.items():
+        print('{0:>12}: {1}'.format(outcome, len(found)))
+        lines = ['\t'.join(r).strip() for r in found]
+        writeFile('reconcile_' + outcome, '\n'.join(lines), '.txt')
+
+    # Write the files to ingest for the missing PIDs
+    missing = [pid for pid, xmlType, detail in results['missing']]
+    index = readFoxmlIndex(summaryDir)
+    manifest = openManifest()
+    writeFile('reconcile_ingest', '\n'.join(foxmlPath(index, manifest, pid) for pid in missing), '.txt')
+    manifest.close()
+    print('\nResults written to output/reconcile_*.txt; the FOXML files of the missing PIDs are listed')
+    print('in output/reconcile_ingest.txt.')
     
-    rightsScheme = getRightsScheme()
+    # The missing records can be generated again with their original PIDs (see regenerate)
+    if missing:
+        choice = input('\nRegenerate the FOXML of the {0} missing PIDs? Enter Y or N: '.format(len(missing)))
+        while choice not in ('Y', 'N'):
+            choice = input('You must enter Y or N: ')
+        if choice == 'Y':
+            regenerate(*missing)
+
+
+# Regenerates the FOXML files of selected records with their original PIDs. Each PID or
+# Identifier given is looked up in the manifest to find the batch and data row it came from;
+# the data file's row offset index then locates the object group of that row, which is read
+# straight from the file and rendered again with the batch's templates and rights scheme.
+# The data file may have been corrected since, as long as rows were not added or removed.
+def regenerate(*terms):
+    global foxmlLayout, digestAlgorithm, singleRowContext, convertTime
+    if not terms:
+        terms = input('\nEnter the PIDs and/or Identifiers to regenerate, separated by spaces: ').split()
+    manifest = openManifest()
     
+    # Find the latest batch and row of each term
+    targets = {}
+    for term in terms:
+        found = manifest.execute('''SELECT batch, row FROM records WHERE pid = :term
+                                    UNION SELECT batch, row FROM records WHERE identifier = :term
+                                    ORDER BY batch DESC''', {'term' : term}).fetchall()
+        if not found:
+            print('{0}: not found in the manifest!'.format(term))
+            continue
+        latest = found[0][0]
+        targets.setdefault(latest, set()).update(row for batch, row in found if batch == latest)
+    if not targets:
+        manifest.close()
+        return
     convertTime = timeFormatSelection()
-    print(convertTime)
-    
-    # Load the UMAM template and print it to screen  
-    umam, umamName = loadFile('UMAM')
-    print("\n UMAM:\n" + umam)
-    print('*' * 30)
+    timeStamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    filesWritten = 0
     
-    # Load the UMDM template and print it to screen
-    umdm, umdmName = loadFile('UMDM')
-    print("\n UMDM:\n" + umdm)
-    print('*' * 30)
+    for batch, rows in sorted(targets.items()):
+        operator, dataFileName, arrangement, settings = manifest.execute(
+            'SELECT operator, dataFile, arrangement, settings FROM batches WHERE batch = ?', (batch,)).fetchone()
+        settings = json.loads(settings)
+        print('\nBatch {0} ({1}, run by {2}):'.format(batch, dataFileName, operator))
+        while not os.path.exists(dataFileName):
+            dataFileName = input('Data file {0} not found, enter its current location: '.format(dataFileName))
+        foxmlLayout = settings.get('foxmlLayout', 'flat')
+        digestAlgorithm = settings.get('digestAlgorithm', 'sha256')     # as in the batch's checksums.txt
+        rights = settings['rights']
+        if isinstance(settings['umam'], str):     # a single UMAM template, before the registry
+            umam = loadUmamTemplates({kind : dict(umamTemplates[defaultMediaKind], file=settings['umam'])
+                                      for kind in umamTemplates})
+        else:
+            umam = loadUmamTemplates(settings['umam'])
+        umdm = compileTemplate(readTemplateFile(settings['umdm']))
+        reportTemplateCoverage(umam, umdm, settings['umdm'])
+        encoding = settings.get('encoding') or sniffEncoding(dataFileName)
+        index = openRowIndex(dataFileName, encoding, arrangement)
+        startBatch(manifest, timeStamp + '/' + batch, operator, dataFileName, arrangement,
+                   dict(settings, regenerates=batch, digestAlgorithm=digestAlgorithm))
+        resetValueTables()
+        
+        # Collect the PIDs of the batch's rows
+        pids = {}
+        for row, xmlType, pid, seq in manifest.execute('SELECT row, xmlType, pid, seq FROM records ' +
+                                                       'WHERE batch = ?', (batch,)):
+            pids[(row, xmlType)] = (pid, seq)
+        
+        groups = set()
+        for row in rows:
+            found = index.execute('SELECT grp FROM rows WHERE row = ?', (row,)).fetchone()
+            if found is None or found[0] is None:
+                print('Skipping data row {0}: it is no longer part of an object in the data file!'.format(row + 1))
+                continue
+            groups.add(found[0])
+        for group in sorted(groups):
+            myData = readGroup(dataFileName, encoding, index, group)
+            
+            # Make sure the rows still belong to the records generated from them
+            recorded = manifest.execute('SELECT identifier FROM records WHERE batch = ? AND row = ?',
+                                        (batch, myData[0].row)).fetchone()
+            if recorded is None or recorded[0] != myData[0]['Identifier']:
+                print('Skipping data row {0}: its Identifier no longer matches the manifest!'.format(myData[0].row + 1))
+                continue
+            print('\nREGENERATING GROUP {0} (data row {1}):'.format(group + 1, myData[0].row + 1))
+            if arrangement == 'S':
+                x = myData[0]
+                x.umdmPid, x.seq = pids[(x.row, 'UMDM')]
+                x.umamPid = pids[(x.row, 'UMAM')][0]
+                singleRowContext = {'rowType' : type(x), 'umam' : umam, 'umdm' : umdm, 'rights' : rights}
+                umamPath, umamDigest, umdmPath, umdmDigest, runTime = generateSingleRowObject(
+                    (x.values, x.row, x.umdmPid, x.umamPid))
+                recordFile(manifest, timeStamp + '/' + batch, x.seq + 1, x.row, x, x.umamPid, 'UMAM',
+                           x.umdmPid, umamPath, umamDigest)
+                recordFile(manifest, timeStamp + '/' + batch, x.seq, x.row, x, x.umdmPid, 'UMDM',
+                           None, umdmPath, umdmDigest)
+                print('UMAM = {0}, UMDM = {1}'.format(umamPath, umdmPath))
+                filesWritten += 2
+            else:
+                # Make sure the group still has the UMAMs its UMDM was generated with
+                if any((x.row, x['XMLType']) not in pids for x in myData):
+                    print('Skipping group {0}: its rows no longer match the manifest!'.format(group + 1))
+                    continue
+                for x in myData:
+                    x.pid, x.seq = pids[(x.row, x['XMLType'])]
+                recordedParts = manifest.execute('''SELECT COUNT(*) FROM records WHERE batch = ? AND
+                                                    xmlType = 'UMAM' AND parentPid = ?''',
+                                                 (batch, myData[0].pid)).fetchone()[0]
+                if recordedParts != len(myData) - 1:
+                    print('Skipping group {0}: it has {1} UMAM rows, but its UMDM was generated with {2}!'.format(
+                          group + 1, len(myData) - 1, recordedParts))
+                    continue
+                filesWritten += generateGroup(manifest, timeStamp + '/' + batch, myData, umam, umdm, rights)
+        index.close()
+    manifest.commit()
+    for batch in targets:
+        updateSummaries(manifest, timeStamp + '/' + batch)
+    manifest.close()
+    print('\n{0} FOXML files regenerated.'.format(filesWritten))
+
+
+# Generates the FOXML files for all the rows of a batch, attaching PIDs from pidList in order,
+# and records them in the manifest. Each row is also added to the data file's row index, if
+# one is given (see startRowIndex). Returns the number of files written and of object groups.
+def generateBatch(manifest, timeStamp, myData, dataFileArrangement, pidList, umam, umdm, rightsScheme, index=None):
+    global singleRowContext
     
-    # Load the lines of the data file into a csv.DictReader object
-    myData = csv.DictReader(dataFile)
-    print('Data successfully read.')
+    # Initialize needed variables and lists
+    resetValueTables()
+    objectGroups = 0    # counter for UMDM plus UMAM(s) as a group
+    pidCounter = 0      # counter for coordinating PID list with data lines from CSV
+    filesWritten = 0    # counter for file outputs
+    indexGroup = -1     # group of the last row added to the index
     
     # Generate XML for data arranged with multiple lines (UMAM and UMDM) per object
     if dataFileArrangement == 'M':
         
+        group = []      # rows of the current object, starting with its UMDM
         for x in myData:
             
+            # Record the row in the index, with the group it is generated in
+            if index is not None:
+                xGroup = rowGroup('M', x['XMLType'], indexGroup)
+                indexGroup = indexGroup if xGroup is None else xGroup
+                indexRow(index, x, xGroup)
+            
+            # Skip rows which are neither UMDM nor UMAM, as reported by the planner
+            if x['XMLType'] not in ('UMDM', 'UMAM'):
+                continue
+            
             # Attach a PID to the line of data.
-            x['PID'] = pidList[pidCounter]
+            x.pid = pidList[pidCounter]
+            x.seq = pidCounter
             pidCounter += 1
             
-            # Attach summary info to summary list, depending on XML type
-            if x['XMLType'] == 'UMDM':
-                link = '"{0}","{1}","{2}","http://digital.lib.umd.edu/video?pid={2}"'.format(x['Identifier'],
-                                                                                             x['XMLType'], x['PID'])
-            elif x['XMLType'] == 'UMAM':
-                link = '"{0}","{1}","{2}"'.format(x['Identifier'], x['XMLType'], x['PID'])
-            summaryList.append(link)
-            
             # Check the XML type for each line, and build the FOXML files accordingly
             if x['XMLType'] == 'UMDM':
                 
-                # If the mets variable is NOT empty, finish the UMDM for the previous group
-                if mets != "":
-                    myFile = createUMDM(tempData, umdm, summedRunTime, mets, tempData['PID'], rightsScheme)
-                    fileStem = tempData['PID'].replace(':', '_').strip()    # convert ':' to '_' in PID for use in filename
-                    writeFile(fileStem, myFile, '.xml')                     # Write the file
-                    
-                    # Print summary info to the screen
-                    print('Creating UMDM for object with {0} parts...'.format(objectParts), end=" ")
-                    print('\nTotal runtime of all parts = {0}.'.format(str(summedRunTime)))
-                    print('UMDM = {0}'.format(fileStem))
-                    
-                    # Append PID to list of all files created and list of UMDM files created
-                    umdmList.append(tempData['PID'])
-                    outputFiles.append(tempData['PID'])
-                    filesWritten += 1
-                    
-                    # Reset counters
-                    objectParts = 0     # reset parts counter
-                    summedRunTime = 0   # reset runtime sum counter for masters
+                # If there is a group in progress, write its UMAMs and UMDM
+                if group:
+                    filesWritten += generateGroup(manifest, timeStamp, group, umam, umdm, rightsScheme)
                 
                 # Begin a new UMDM group by incrementing the group counter, printing a notice to screen,
-                # storing the line of UMDM data for use after UMAMs are complete, and initiating a new METS
+                # and storing the line of UMDM data for use after UMAMs are complete
                 objectGroups += 1
                 print('\nFILE GROUP {0}: '.format(objectGroups))
-                tempData = x
-                mets = createMets()
+                group = [x]
                 
-            # If the line is a UMAM line
+            # If the line is a UMAM line, add it to the group
             elif x['XMLType'] == 'UMAM':
+                group.append(x)
                 
-                # Print summary info to the screen
-                print('Writing UMAM...', end=' ')
-                
-                # Create UMAM, convert PID for use as filename, write the file
-                myFile = createUMAM(x, umam, x['PID'], rightsScheme)
-                convertedDerivativeRunTime = convertTime(x['DurationDerivatives'])
-                fileStem = x['PID'].replace(':', '_').strip()
-                print('Part {0}: UMAM = {1}'.format(objectParts, fileStem))
-                writeFile(fileStem, myFile, '.xml')
-                
-                # Increment counters
-                outputFiles.append(x['PID'])
-                summedRunTime += convertedDerivativeRunTime
-                objectParts += 1
-                filesWritten += 1
-                
-                # Update the running METS record for use in finishing the UMDM
-                mets = updateMets(objectParts, mets, x['FileName'], x['PID'])
-                
-        # After iteration complete, finish the last UMDM    
-        myFile = createUMDM(tempData, umdm, summedRunTime, mets, tempData['PID'], rightsScheme)
-        fileStem = tempData['PID'].replace(':', '_').strip()    # convert ':' to '_' in PID for use in filename
-        writeFile(fileStem, myFile, '.xml')                     # Write the file
-        
-        # Print summary info to the screen
-        print('Creating UMDM for object with {0} parts...'.format(objectParts), end=" ")
-        print('\nTotal runtime of all parts = {0}.'.format(str(summedRunTime)))
-        print('UMDM = {0}'.format(fileStem))
-                    
-        # Append PID to list of all files created and list of UMDM files created
-        umdmList.append(tempData['PID'])
-        outputFiles.append(tempData['PID'])
-        filesWritten += 1
+        # After iteration complete, finish the last group
+        if group:
+            filesWritten += generateGroup(manifest, timeStamp, group, umam, umdm, rightsScheme)
         
     # Generate XML for data arranged with single lines (UMAM plus UMDM) per object
     elif dataFileArrangement == 'S':
         
-        # Assign two PIDs to each line
+        # Assign two PIDs to each line, the first for the UMDM and the second for the UMAM
+        myData = list(myData)
         for x in myData:
-            x['umdmPID'] = pidList[pidCounter]
-            pidCounter += 1
-            x['umamPID'] = pidList[pidCounter]
-            pidCounter += 1
-            
-            # Attach summary info to summary list, once for each file
-            link1 = '"{0}","{1}","{2}","http://digital.lib.umd.edu/video?pid={2}"'.format(x['Identifier'],
-                                                                                          'UMDM', x['umdmPID'])
-            link2 = '"{0}","{1}","{2}"'.format(x['Identifier'],
-                                               'UMAM', x['umamPID'])
-            summaryList.append(link1)
-            summaryList.append(link2)
+            if index is not None:
+                indexGroup = rowGroup('S', '', indexGroup)
+                indexRow(index, x, indexGroup)
+            x.seq = pidCounter
+            x.umdmPid = pidList[pidCounter]
+            x.umamPid = pidList[pidCounter + 1]
+            pidCounter += 2
+        
+        # Each row is an independent object, so the rows are rendered and written in parallel
+        tasks = [(x.values, x.row, x.umdmPid, x.umamPid) for x in myData]
+        if myData:
+            singleRowContext = {'rowType' : type(myData[0]), 'umam' : umam, 'umdm' : umdm,
+                                'rights' : rightsScheme}
+        if 'fork' in multiprocessing.get_all_start_methods():
+            pool = multiprocessing.get_context('fork').Pool(singleRowWorkers)
+            chunkSize = max(1, len(tasks) // (singleRowWorkers * 8))
+            results = pool.imap(generateSingleRowObject, tasks, chunkSize)
+        else:
+            pool = None
+            results = map(generateSingleRowObject, tasks)
+        
+        for x, (umamPath, umamDigest, umdmPath, umdmDigest, runTime) in zip(myData, results):
             
             # Increment the object counter and print feedback to screen
             objectGroups += 1
             print('\nFILE GROUP {0}: '.format(objectGroups))
+            print('Part 1: UMAM = {0}'.format(x.umamPid.replace(':', '_').strip()))
+            print('Creating UMDM for object with 1 parts...', end=" ")
+            print('\nTotal runtime of all parts = {0}.'.format(str(runTime)))
+            print('UMDM = {0}'.format(x.umdmPid.replace(':', '_').strip()))
             
-            # Initiate the METS
-            mets = createMets()
-            
-            # Create UMAM, convert PID for use as filename, write the file
-            myFile = createUMAM(x, umam, x['umamPID'], rightsScheme)
-            fileStem = x['umamPID'].replace(':', '_').strip()
-            writeFile(fileStem, myFile, '.xml')
-            
-            # Increment counters
-            summedRunTime += convertedDerivativeRunTime
-            objectParts += 1
-            filesWritten += 1
-            
-            # Update the running METS record for use in finishing the UMDM
-            mets = updateMets(objectParts, mets, x['File Name'], x['umamPID'])
-            
-            # Print summary info to the screen
-            print('Part {0}: UMAM = {1}'.format(objectParts, fileStem))
-            print('Writing UMAM...', end=' ')
-            
-            # Create UMDM
-            createUMDM(x, umdm, summedRunTime, mets, x['umdmPID'])
-            
-            # Print summary info to the screen
-            print('Creating UMDM for object with {0} parts...'.format(objectParts), end=" ")
-            print('\nTotal runtime of all parts = {0}.'.format(str(summedRunTime)))
-            print('UMDM = {0}'.format(fileStem))
-            
-            # Append PID to list of all files created and list of UMDM files created
-            umdmList.append(x['umdmPID'])
-            outputFiles.append(x['umdmPID'])
-            filesWritten += 1
-          
-            # Reset counters
-            objectParts = 0     # reset parts counter
-            summedRunTime = 0   # reset runtime sum counter
+            # Record both files in the manifest
+            recordFile(manifest, timeStamp, x.seq + 1, x.row, x, x.umamPid, 'UMAM',
+                       x.umdmPid, umamPath, umamDigest)
+            recordFile(manifest, timeStamp, x.seq, x.row, x, x.umdmPid, 'UMDM',
+                       None, umdmPath, umdmDigest)
+            filesWritten += 2
+        
+        if pool is not None:
+            pool.close()
+            pool.join()
         
     # Abort if the value of dataFileArrangement is something else
     else:
         print('Bad dataFileArrangement value!')
         quit()
-        
-    # Generate summary files
-    print('\nWriting pidlist file as pids.txt...')
-    f = '\n'.join(outputFiles)
-    writeFile('pids', f, '.txt')
-    filesWritten += 1
     
-    print('Writing summary file as links.txt...')
-    l = '\n'.join(summaryList)
-    writeFile('links', l, '.txt')
-    filesWritten += 1
+    return filesWritten, objectGroups
+
+
+# Decides whether a CSV dropped into the inbox has been completely written: its size and
+# modification time must not have changed for watchSettle seconds, and it must not end in the
+# middle of a quoted value (a sign that the file is still being written). A file found to end
+# in a quoted value is not parsed again until it changes, and raises a ValueError if it stays
+# unchanged for watchIncomplete seconds, as its quotes will never balance.
+def fileIsComplete(path, seen):
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    now = time.monotonic()
+    if path not in seen or seen[path][0] != signature:
+        seen[path] = [signature, now, False]    # signature, when it was first seen, found incomplete
+        return False
+    signature, since, incomplete = seen[path]
+    if now - since < watchSettle:
+        return False
+    if incomplete:
+        if now - since >= watchIncomplete:
+            raise ValueError('The file ends in the middle of a quoted value, and has not changed for '
+                             '{0} seconds'.format(watchIncomplete))
+        return False
+    with open(path, 'r', newline='', errors='replace') as f:
+        try:
+            for record in csv.reader(f, strict=True):
+                pass
+        except csv.Error:
+            seen[path][2] = True
+            return False
+    return True
+
+
+# Moves a data file that could not be processed to the failed folder, with a [name].log
+# explaining why.
+def failDataFile(folder, path, name, e):
+    os.replace(path, os.path.join(folder, 'failed', name))
+    writeLog = open(os.path.join(folder, 'failed', name + '.log'), 'w')
+    writeLog.write('{0}: {1}\n'.format(type(e).__name__, e))
+    writeLog.close()
+    print('FAILED: {0}: {1}: {2}'.format(name, type(e).__name__, e))
+
+
+# Takes PIDs from the reserved pool, topping it up from the server when it runs low (new PIDs
+# are saved to the pool file at once). The pool file is saved in the hot folder, so PIDs
+# reserved but not used survive a restart of the watcher; the PIDs taken only leave it once
+# their batch is recorded (see processDataFile), so a batch that fails or is interrupted
+# does not lose them.
+def takePids(pool, numPids, session, baseUrl, poolFile):
+    if len(pool) < numPids:
+        numRequested = max(numPids - len(pool), watchPidPool)
+        print('Reserving {0} more PIDs from the server...'.format(numRequested))
+        pool.extend(parsePids(fetchPids(session, baseUrl, numRequested)))
+        writePoolFile(pool, poolFile)
+    taken = pool[:numPids]
+    del pool[:numPids]
+    return taken
+
+
+# Saves the PIDs remaining in the pool, one per line.
+def writePoolFile(pool, poolFile):
+    f = open(poolFile, 'w')
+    f.write('\n'.join(pool))
+    f.close()
+
+
+# Generates the FOXML for one data file taken from the inbox, with the templates, rights scheme
+# and PID pool already loaded. Raises an exception if the file cannot be processed as it is.
+def processDataFile(path, donePath, operator, settings, umam, umdm, pool, session, baseUrl, poolFile):
+    timeStamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    dataFile = readDataFile(path)
+    if dataFile.problems:
+        raise ValueError('Lines that are not valid {0}:\n'.format(dataFile.encoding) +
+                         '\n'.join('Line {0}: {1}'.format(*p) for p in dataFile.problems))
+    plan = analyzeDataFile(dataFile, interactive=False)
+    reportUnusedColumns(dataFile, umam, umdm)
+    manifest = openManifest()
+    try:
+        conflicts = findDuplicates(dataFile, plan['arrangement'], manifest)
+        if conflicts:
+            raise ValueError('Duplicate Identifiers/FileNames:\n' + '\n'.join(conflicts))
+        pidList = takePids(pool, plan['pidsNeeded'], session, baseUrl, poolFile)
+        index = None
+        newIndex = not os.path.exists(donePath + '.idx')
+        try:
+            startBatch(manifest, timeStamp, operator, donePath, plan['arrangement'],
+                       dict(settings, encoding=dataFile.encoding))
+            index = startRowIndex(donePath, dataFile, plan['arrangement'])
+            filesWritten, objectGroups = generateBatch(manifest, timeStamp, readRows(dataFile),
+                                                       plan['arrangement'], pidList, umam, umdm,
+                                                       settings['rights'], index)
+            finishRowIndex(index, path)
+            manifest.commit()
+        except BaseException:
+            # Nothing of the batch is in the manifest, so its PIDs go back to the pool to be reused
+            # (any FOXML files written for them will be overwritten)
+            pool[:0] = pidList
+            if index is not None:
+                index.close()           # the index of an earlier file of the same name is left as it was
+                if newIndex:
+                    os.remove(donePath + '.idx')
+            raise
+        writePoolFile(pool, poolFile)
+        exportSummaries(manifest, timeStamp)
+    finally:
+        manifest.close()
+    return filesWritten, objectGroups
+
+
+# Watches a hot folder for data files, generating their FOXML as soon as they are dropped into
+# its inbox. Files move through the inbox, processing, done and failed subfolders; a file that
+# fails is accompanied by a [name].log explaining why. The templates, rights scheme and a pool
+# of reserved PIDs are set up once when the watcher starts, so each file is processed at once.
+def watch(folder='hotfolder'):
+    global convertTime
+    for state in ('inbox', 'processing', 'done', 'failed'):
+        os.makedirs(os.path.join(folder, state), exist_ok=True)
     
-    print('Writing list of UMDM files as UMDMpids.txt...')
-    d = '\n'.join(umdmList)
-    writeFile('UMDMpids', d, '.txt')
-    filesWritten += 1
+    # Set up everything that would otherwise be asked for each file
+    operator = greeting()
+    rightsScheme = getRightsScheme()
+    convertTime = timeFormatSelection()
+    umam = loadUmamTemplates()
+    umdm, umdmName = loadFile('UMDM')
+    umdm = compileTemplate(umdm)
+    reportTemplateCoverage(umam, umdm, umdmName)
+    settings = {'rights' : rightsScheme, 'umam' : umamTemplates, 'umdm' : umdmName, 'foxmlLayout' : foxmlLayout,
+                'digestAlgorithm' : digestAlgorithm}
+    baseUrl = chooseServer('get PIDs')
+    session = createSession(getCredentials())
+    poolFile = os.path.join(folder, 'pidpool.txt')
+    if os.path.exists(poolFile):
+        pool = [p for p in open(poolFile, 'r').read().split() if p]
+        # Drop any PIDs used by a batch which was recorded just before the watcher was stopped
+        manifest = openManifest()
+        pool = [p for p in pool if not manifest.execute('SELECT 1 FROM records WHERE pid = ?', (p,)).fetchone()]
+        manifest.close()
+    else:
+        pool = []
+    if len(pool) < watchPidPool:
+        pool.extend(parsePids(fetchPids(session, baseUrl, watchPidPool - len(pool))))
+        writePoolFile(pool, poolFile)
+    print('\n{0} PIDs reserved. Watching {1} for data files (press Ctrl-C to stop)...'.format(len(pool),
+          os.path.join(folder, 'inbox')))
+    
+    seen = {}
+    try:
+        while True:
+            for entry in sorted(os.scandir(os.path.join(folder, 'inbox')), key=lambda e: e.name):
+                if (not entry.is_file() or not entry.name.lower().endswith('.csv') or
+                        entry.name.startswith(('.', '~$'))):
+                    continue
+                try:
+                    if not fileIsComplete(entry.path, seen):
+                        continue
+                except ValueError as e:
+                    del seen[entry.path]
+                    try:
+                        failDataFile(folder, entry.path, entry.name, e)
+                    except FileNotFoundError:               # taken by another watcher
+                        pass
+                    continue
+                del seen[entry.path]
+                start = time.time()
+                path = os.path.join(folder, 'processing', entry.name)
+                try:
+                    os.replace(entry.path, path)
+                except FileNotFoundError:                   # taken by another watcher
+                    continue
+                print('\n' + ('*' * 30) + '\nProcessing {0}...'.format(entry.name))
+                try:
+                    donePath = os.path.join(folder, 'done', entry.name)
+                    filesWritten, objectGroups = processDataFile(path, donePath, operator, settings, umam, umdm,
+                                                                 pool, session, baseUrl, poolFile)
+                except Exception as e:
+                    failDataFile(folder, path, entry.name, e)
+                    continue
+                os.replace(path, donePath)
+                print('Done: {0} FOXML files in {1} groups from {2} in {3:.2f} seconds.'.format(
+                      filesWritten, objectGroups, entry.name, time.time() - start))
+            time.sleep(watchInterval)
+    except KeyboardInterrupt:
+        print('\nStopped watching. {0} reserved PIDs saved in {1}.'.format(len(pool), poolFile))
+
+
+def main():
+    
+    global convertTime
+    
+    # Create a timeStamp for these operations, which also serves as the batch id in the manifest
+    timeStamp = datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    
+    # Initiate the program, recording the timestamp and name of user
+    operator = greeting()
+    
+    # Load CSV data
+    dataFile, fileName = loadFile('data')
+    
+    # Report any lines that could not be decoded
+    reportDecodeProblems(dataFile)
+    
+    # Scan the loaded data to detect its arrangement and calculate the number of PIDs needed
+    plan = analyzeDataFile(dataFile)
+    pidsNeeded = plan['pidsNeeded']
+    dataFileArrangement = plan['arrangement']
+    
+    # Check for Identifiers and FileNames already generated before consuming any PIDs
+    manifest = openManifest()
+    reportDuplicates(findDuplicates(dataFile, dataFileArrangement, manifest))
+    
+    rightsScheme = getRightsScheme()
+    
+    convertTime = timeFormatSelection()
+    print(convertTime)
+    
+    # Load the UMAM template for each kind of media (see umamTemplates)
+    print()
+    umam = loadUmamTemplates()
+    print('*' * 30)
+    
+    # Load the UMDM template and print it to screen
+    umdm, umdmName = loadFile('UMDM')
+    print("\n UMDM:\n" + umdm)
+    print('*' * 30)
+    umdm = compileTemplate(umdm)
+    
+    # Report the template anchors left unmapped and the data columns left unused
+    reportTemplateCoverage(umam, umdm, umdmName)
+    reportUnusedColumns(dataFile, umam, umdm)
+    
+    # Estimate the size of the output and the time needed to generate it
+    estimateOutput(plan, dataFile, umam, umdm, rightsScheme)
+    
+    # Request PIDs from the server OR load PIDs from previously saved file.
+    pidFile = getPids(pidsNeeded)
+    
+    # Parse the XML PID file (either local or from the server) to get list of PIDs
+    pidList = parsePids(pidFile)
+    
+    # Check whether the loaded file has enough PIDs, abort if not enough
+    if len(pidList) < pidsNeeded:
+        print('Not enough PIDs for your dataset!')
+        print('Please reserve additional PIDs from the server and try again.')
+        print('Exiting program.')
+        quit()
+    
+    # Load the lines of the data file as DataRow records
+    myData = readRows(dataFile)
+    print('Data successfully read.')
+    
+    # Register this run as a new batch in the manifest
+    startBatch(manifest, timeStamp, operator, fileName, dataFileArrangement,
+               {'rights' : rightsScheme, 'umam' : umamTemplates, 'umdm' : umdmName, 'foxmlLayout' : foxmlLayout,
+                'encoding' : dataFile.encoding, 'digestAlgorithm' : digestAlgorithm})
+    
+    # Generate the FOXML files, indexing the rows of the data file for regenerate as they are read
+    index = startRowIndex(fileName, dataFile, dataFileArrangement)
+    filesWritten, objectGroups = generateBatch(manifest, timeStamp, myData, dataFileArrangement, pidList,
+                                               umam, umdm, rightsScheme, index)
+    finishRowIndex(index, fileName)
+        
+    # Generate summary files from the manifest
+    filesWritten += exportSummaries(manifest, timeStamp)
+    manifest.close()
     
     # Print a divider and summarize output to the screen.
     print('\n' + ('*' * 30))               
-    print('\n{0} files written: {1} FOXML files in {2}'.format(filesWritten, filesWritten - 3,
+    print('\n{0} files written: {1} FOXML files in {2}'.format(filesWritten, filesWritten - 5,
                                                                objectGroups), end=' ')
-    print('groups, plus the summary list of pids, list of UMDM pids, and the links file.')
+    print('groups, plus the summary list of pids, list of UMDM pids, the links file, the FOXML index',
+          'and the checksums.')
     print('Thanks for using the XML generator!\n\n')
-        
-main()
+
+
+# Additional modes of operation, selected by the first command-line argument
+commands = {
+            'lookup' :      lookupRecords,
+            'reconcile' :   reconcile,
+            'regenerate' :  regenerate,
+            'watch' :       watch
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        commands[sys.argv[1]](*sys.argv[2:])
+    else:
+        main()